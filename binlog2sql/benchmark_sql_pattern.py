@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+行转换微基准：对比旧的两次 map(fix_object) 转换与单次 convert_row_values 转换的 rows/sec，
+并给出 generate_sql_pattern、concat_sql_from_binlog_event 的整体吞吐。不需要连接 MySQL。
+
+    python benchmark_sql_pattern.py --columns 50 --rows 20000
+"""
+
+import argparse
+import datetime
+import decimal
+import sys
+import time
+from functools import partial
+
+import pymysql
+from pymysqlreplication.row_event import WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent
+from utils.binlog2sql_util import fix_object, convert_row_values, generate_sql_pattern, concat_sql_from_binlog_event
+
+
+class FakePacket(object):
+    log_pos = 1024
+
+
+def new_event(event_class):
+    event = event_class.__new__(event_class)
+    event.schema = 'bench'
+    event.table = 't_bench'
+    event.primary_key = 'c0'
+    event.timestamp = 1700000000
+    event.packet = FakePacket()
+    return event
+
+
+def new_row_values(columns, seed=0):
+    samples = [
+        lambda i: i,
+        lambda i: 'value-%d' % i,
+        lambda i: decimal.Decimal('%d.25' % i),
+        lambda i: datetime.datetime(2023, 1, 1) + datetime.timedelta(seconds=i),
+        lambda i: None,
+        lambda i: b'\x00\xff' * 8,
+        lambda i: {b'k': i, b'v': [1, b'json-%d' % i], b'name': 'json'.encode('utf8')},
+        lambda i: i * 1.5,
+    ]
+    return {'c%d' % i: samples[i % len(samples)](seed + i) for i in range(columns)}
+
+
+def legacy_convert(set_values, where_values):
+    # 旧实现：values、types 各 map 一次，update 时还需要先拼接 list
+    fix_object_new = partial(fix_object, is_return_type=True)
+    values = map(fix_object, list(set_values) + list(where_values))
+    types = map(fix_object_new, list(set_values) + list(where_values))
+    return list(values), list(types)
+
+
+def run(name, func, rows):
+    start = time.perf_counter()
+    for row in rows:
+        func(row)
+    elapsed = time.perf_counter() - start
+    print('%-48s %10.0f rows/sec' % (name, len(rows) / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark row conversion of generate_sql_pattern.')
+    parser.add_argument('--columns', type=int, default=50, help='columns per row, default 50')
+    parser.add_argument('--rows', type=int, default=20000, help='rows per case, default 20000')
+    args = parser.parse_args()
+
+    rows = [{'before_values': new_row_values(args.columns, i), 'after_values': new_row_values(args.columns, i + 1)}
+            for i in range(args.rows)]
+    legacy = [legacy_convert(r['after_values'].values(), r['before_values'].values()) for r in rows[:100]]
+    single = [convert_row_values(r['after_values'].values(), r['before_values'].values()) for r in rows[:100]]
+    if legacy != single:
+        print('convert_row_values result differs from legacy conversion')
+        sys.exit(1)
+
+    print('columns: %s, rows: %s' % (args.columns, args.rows))
+    run('legacy fix_object maps (update)', lambda r: legacy_convert(
+        r['after_values'].values(), r['before_values'].values()), rows)
+    run('convert_row_values (update)', lambda r: convert_row_values(
+        r['after_values'].values(), r['before_values'].values()), rows)
+
+    connection = pymysql.connect(host='127.0.0.1', user='bench', password='', defer_connect=True)
+    connection.server_status = 0
+    cursor = connection.cursor()
+    for event_class in (WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent):
+        event = new_event(event_class)
+        if event_class is UpdateRowsEvent:
+            case_rows = rows
+        else:
+            case_rows = [{'values': r['before_values']} for r in rows]
+        run('generate_sql_pattern (%s)' % event_class.__name__,
+            lambda r: generate_sql_pattern(event, row=r, return_type=True), case_rows)
+        run('concat_sql_from_binlog_event (%s)' % event_class.__name__,
+            lambda r: concat_sql_from_binlog_event(cursor, event, row=r, e_start_pos=4), case_rows)
+
+
+if __name__ == '__main__':
+    main()
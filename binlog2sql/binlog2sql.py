@@ -3,14 +3,21 @@
 import re
 import sys
 import datetime
+import multiprocessing
 import pymysql
 import os
+from functools import partial
 from pymysqlreplication import BinLogStreamReader
-from pymysqlreplication.event import QueryEvent, RotateEvent, FormatDescriptionEvent, GtidEvent
+from pymysqlreplication.event import QueryEvent, RotateEvent, FormatDescriptionEvent, GtidEvent, XidEvent
+from pymysqlreplication.gtid import GtidSet
+from pymysqlreplication.row_event import WriteRowsEvent
 from utils.binlog2sql_util import command_line_args, concat_sql_from_binlog_event, is_dml_event, event_type, logger, \
     set_log_format, get_gtid_set, is_want_gtid, save_result_sql, dt_now, handle_rollback_sql, get_max_gtid, \
-    remove_max_gtid, connect2sync_mysql
-from utils.other_utils import create_unique_file, temp_open, split_condition, merge_rename_args
+    remove_max_gtid, connect2sync_mysql, SyncApplier, ParallelSyncApplier, get_row_keys, event_to_json, \
+    allocate_server_id, parse_server_id_range, rotate_marker, commit_marker, add_executed_gtid, \
+    read_executed_gtid_set, concat_batch_insert_sql
+from utils.other_utils import create_unique_file, temp_open, split_condition, merge_rename_args, \
+    concat_result_files
 
 sep = '/' if '/' in sys.argv[0] else os.sep
 
@@ -24,12 +31,14 @@ class Binlog2sql(object):
                  ignore_columns=None, replace=False, insert_ignore=False, remove_not_update_col=False,
                  result_file=None, result_dir=None, table_per_file=False, date_prefix=False,
                  include_gtids=None, exclude_gtids=None, update_to_replace=False, keep_not_update_col: list = None,
-                 chunk_size=1000, tmp_dir='tmp', no_date=False, where=None, args=None):
+                 chunk_size=1000, tmp_dir='tmp', no_date=False, where=None, stream=False,
+                 output_format='sql', server_id=None, server_id_range=None, result_file_mode='w', batch_insert=False,
+                 max_statement_size=1048576, auto_position=None, gtid_markers=False, args=None):
         """
         conn_setting: {'host': 127.0.0.1, 'port': 3306, 'user': user, 'passwd': passwd, 'charset': 'utf8'}
         """
 
-        if not start_file:
+        if not start_file and not auto_position:
             raise ValueError('Lack of parameter: start_file')
 
         self.conn_setting = connection_settings
@@ -49,6 +58,13 @@ class Binlog2sql(object):
         self.only_schemas = only_schemas if only_schemas else None
         self.only_tables = only_tables if only_tables else None
         self.no_pk, self.flashback, self.stop_never = (no_pk, flashback, stop_never)
+        self.stream = stream
+        self.output_format = output_format
+        # auto_position 时由服务端按已执行的 GTID 集合定位，start_file/start_pos 不参与定位
+        self.auto_position = auto_position if auto_position else None
+        # 流模式下跟踪已执行的 GTID 集合，每个事务结束后输出 commit 行，供调用方以 --auto-position 续传
+        self.track_gtid = stream and (bool(auto_position) or gtid_markers)
+        self.executed_gtid_set = None
         self.only_dml = only_dml
         self.sql_type = [t.upper() for t in sql_type] if sql_type else []
 
@@ -63,8 +79,11 @@ class Binlog2sql(object):
         self.ignore_columns = ignore_columns if ignore_columns is not None else []
         self.replace = replace
         self.insert_ignore = insert_ignore
+        self.batch_insert = batch_insert
+        self.max_statement_size = max_statement_size
         self.remove_not_update_col = remove_not_update_col
         self.result_file = result_file
+        self.result_file_mode = result_file_mode
         self.result_dir = result_dir
         self.table_per_file = table_per_file
         self.date_prefix = date_prefix
@@ -122,24 +141,44 @@ class Binlog2sql(object):
             self.eof_file, self.eof_pos = cursor.fetchone()[:2]
             cursor.execute(SQL_BINLOG_FILES)
             bin_index = [row[0] for row in cursor.fetchall()]
-            if self.start_file not in bin_index:
-                raise ValueError('parameter error: start_file %s not in mysql server' % self.start_file)
-            binlog2i = lambda x: x.split('.')[1]
-            for binary in bin_index:
-                if binlog2i(self.start_file) <= binlog2i(binary) <= binlog2i(self.end_file):
-                    self.binlogList.append(binary)
-
-            cursor.execute("SELECT @@server_id")
-            self.server_id = cursor.fetchone()[0]
+            self.bin_index = bin_index
+            if self.auto_position:
+                # 起始文件由服务端决定，不校验 start_file，默认读到当前 binlog 末尾
+                self.start_file = self.start_file or self.eof_file
+                self.end_file = end_file or self.eof_file
+                self.binlogList = list(bin_index)
+            else:
+                if self.start_file not in bin_index:
+                    raise ValueError('parameter error: start_file %s not in mysql server' % self.start_file)
+                binlog2i = lambda x: x.split('.')[1]
+                for binary in bin_index:
+                    if binlog2i(self.start_file) <= binlog2i(binary) <= binlog2i(self.end_file):
+                        self.binlogList.append(binary)
+
+            # 多个进程同时以同一个 server_id 注册为 slave 时会报 1236，可通过参数指定或按范围分配
+            if server_id:
+                self.server_id = server_id
+            elif server_id_range:
+                self.server_id = allocate_server_id(server_id_range, self.start_file)
+            else:
+                cursor.execute("SELECT @@server_id")
+                self.server_id = cursor.fetchone()[0]
             if not self.server_id:
                 raise ValueError('missing server_id in %s:%s' % (self.conn_setting['host'], self.conn_setting['port']))
 
     def process_binlog(self):
+        if self.track_gtid:
+            if self.auto_position:
+                self.executed_gtid_set = GtidSet(self.auto_position)
+            else:
+                self.executed_gtid_set = read_executed_gtid_set(self.conn_setting, self.server_id,
+                                                                self.start_file, self.start_pos)
         stream = BinLogStreamReader(connection_settings=self.conn_setting, server_id=self.server_id,
                                     log_file=self.start_file, log_pos=self.start_pos, only_schemas=self.only_schemas,
                                     only_tables=self.only_tables, resume_stream=True, blocking=True,
-                                    ignored_schemas=self.ignore_databases, ignored_tables=self.ignore_tables)
-        mode = 'w'
+                                    ignored_schemas=self.ignore_databases, ignored_tables=self.ignore_tables,
+                                    auto_position=self.auto_position)
+        mode = self.result_file_mode
         if self.result_file:
             result_sql_file = self.result_file
             logger.info(f'Saving result into file: [{result_sql_file}]')
@@ -148,6 +187,8 @@ class Binlog2sql(object):
             logger.info(f'Saving table per file into dir: [{self.result_dir}]')
 
         binlog_gtid = ''
+        # 已输出 commit 行的最后一个事务
+        committed_gtid = ''
         gtid_set = True if self.gtid_set else False
         flag_last_event = False
         e_start_pos, last_pos = stream.log_pos, stream.log_pos
@@ -157,10 +198,15 @@ class Binlog2sql(object):
 
         sync_conn = ''
         sync_cursor = ''
+        sync_applier = None
         with temp_open(tmp_file, "w") as f_tmp, self.connection.cursor() as cursor:
             if self.args and self.args.sync:
                 sync_conn = connect2sync_mysql(self.args)
                 sync_cursor = sync_conn.cursor()
+                if self.args.sync_workers > 1:
+                    sync_applier = ParallelSyncApplier(partial(connect2sync_mysql, self.args), self.args.sync_workers)
+                else:
+                    sync_applier = SyncApplier(sync_conn)
             for binlog_event in stream:
                 # 返回的 EVENT 顺序
                 # RotateEvent
@@ -198,10 +244,37 @@ class Binlog2sql(object):
                     # else:
                     #     raise ValueError('unknown binlog file or position')
 
+                # 流模式下，每次切换 binlog 文件都告知调用方，便于其记录同步位点
+                if self.stream and isinstance(binlog_event, RotateEvent):
+                    print(rotate_marker(binlog_event.next_binlog, binlog_event.position, self.output_format),
+                          flush=True)
+
                 if isinstance(binlog_event, QueryEvent) and binlog_event.query == 'BEGIN':
                     e_start_pos = last_pos
 
+                # 同步模式下，源事务结束时提交目标事务
+                if sync_applier and (isinstance(binlog_event, XidEvent) or
+                                     (isinstance(binlog_event, QueryEvent) and binlog_event.query == 'COMMIT')):
+                    try:
+                        sync_applier.commit()
+                    except Exception:
+                        logger.exception('Could not commit sync transaction')
+                        logger.error(
+                            f'Exit at binlog file {stream.log_file} '
+                            f'start pos {e_start_pos} end pos {binlog_event.packet.log_pos}'
+                        )
+                        break
+
+                if self.track_gtid and binlog_gtid and (isinstance(binlog_event, XidEvent) or (
+                        isinstance(binlog_event, QueryEvent) and binlog_event.query == 'COMMIT')):
+                    self.print_commit_marker(stream.log_file, binlog_event.packet.log_pos, binlog_gtid)
+                    committed_gtid = binlog_gtid
+
                 if isinstance(binlog_event, GtidEvent):
+                    # DDL 没有 XidEvent/COMMIT，下一个事务开始时上一个事务已结束
+                    if self.track_gtid and binlog_gtid and binlog_gtid != committed_gtid:
+                        self.print_commit_marker(stream.log_file, last_pos, binlog_gtid)
+                        committed_gtid = binlog_gtid
                     binlog_gtid = str(binlog_event.gtid)
                     if self.gtid_max_dict:
                         remove_max_gtid(self.gtid_max_dict, binlog_gtid)
@@ -221,6 +294,7 @@ class Binlog2sql(object):
                         remove_not_update_col=self.remove_not_update_col, binlog_gtid=binlog_gtid,
                         update_to_replace=self.update_to_replace, keep_not_update_col=self.keep_not_update_col,
                         filter_conditions=self.filter_conditions, rename_tb_dict=self.rename_tb_dict,
+                        add_comment=self.output_format == 'sql',
                     )
                     if sql:
                         if self.need_comment != 1:
@@ -228,7 +302,9 @@ class Binlog2sql(object):
 
                         if not self.flashback:
                             if self.f_result_sql_file:
-                                self.f_result_sql_file.write(sql + '\n')
+                                self.f_result_sql_file.write(
+                                    self.format_result(sql, binlog_event, stream.log_file, last_pos, db, table,
+                                                       binlog_gtid) + '\n')
                             elif self.table_per_file:
                                 if db and table:
                                     if self.date_prefix:
@@ -247,11 +323,10 @@ class Binlog2sql(object):
                                 result_sql_file = os.path.join(self.result_dir, filename)
                                 save_result_sql(result_sql_file, sql + '\n')
                             elif sync_cursor:
-                                sync_conn.ping(reconnect=True)
                                 if re.match('USE .*;\n', sql) is not None:
                                     sql = re.sub('USE .*;\n', '', sql)
                                 try:
-                                    sync_cursor.execute(sql)
+                                    sync_applier.execute(sql)
                                 except:
                                     logger.exception(f'Could not execute sql: {sql}')
                                     logger.error(
@@ -260,7 +335,8 @@ class Binlog2sql(object):
                                     )
                                     break
                             else:
-                                print(sql)
+                                print(self.format_result(sql, binlog_event, stream.log_file, last_pos, db, table,
+                                                         binlog_gtid), flush=self.stream)
                         else:
                             if flashback_warn_flag == 1:
                                 logger.warning(f'Saving the result into the temp file, please wait until the parsing '
@@ -269,19 +345,36 @@ class Binlog2sql(object):
                             f_tmp.write(sql + '\n')
                 elif is_dml_event(binlog_event) and event_type(binlog_event) in self.sql_type:
                     exit_flag = 0
-                    for row in binlog_event.rows:
-                        if binlog_gtid and gtid_set and not is_want_gtid(self.gtid_set, binlog_gtid):
-                            continue
-
-                        sql, db, table = concat_sql_from_binlog_event(
-                            cursor=cursor, binlog_event=binlog_event, no_pk=self.no_pk, row=row,
-                            flashback=self.flashback, e_start_pos=e_start_pos, rename_db_dict=self.rename_db_dict,
-                            only_pk=self.only_pk, ignore_columns=self.ignore_columns, replace=self.replace,
-                            insert_ignore=self.insert_ignore, remove_not_update_col=self.remove_not_update_col,
-                            only_return_sql=False, binlog_gtid=binlog_gtid, update_to_replace=self.update_to_replace,
-                            keep_not_update_col=self.keep_not_update_col, filter_conditions=self.filter_conditions,
-                            rename_tb_dict=self.rename_tb_dict,
+                    if isinstance(sync_applier, ParallelSyncApplier):
+                        sync_applier.add_keys(get_row_keys(binlog_event))
+                    # gtid 过滤按事件判断一次即可
+                    if binlog_gtid and gtid_set and not is_want_gtid(self.gtid_set, binlog_gtid):
+                        results = []
+                    elif self.batch_insert and not self.flashback and isinstance(binlog_event, WriteRowsEvent):
+                        results = concat_batch_insert_sql(
+                            cursor, binlog_event, binlog_event.rows, e_start_pos=e_start_pos,
+                            max_statement_size=self.max_statement_size, no_pk=self.no_pk,
+                            rename_db_dict=self.rename_db_dict, rename_tb_dict=self.rename_tb_dict,
+                            ignore_columns=self.ignore_columns, replace=self.replace,
+                            insert_ignore=self.insert_ignore, binlog_gtid=binlog_gtid,
+                            filter_conditions=self.filter_conditions, add_comment=self.output_format == 'sql',
                         )
+                    else:
+                        results = (
+                            concat_sql_from_binlog_event(
+                                cursor=cursor, binlog_event=binlog_event, no_pk=self.no_pk, row=row,
+                                flashback=self.flashback, e_start_pos=e_start_pos,
+                                rename_db_dict=self.rename_db_dict, only_pk=self.only_pk,
+                                ignore_columns=self.ignore_columns, replace=self.replace,
+                                insert_ignore=self.insert_ignore, remove_not_update_col=self.remove_not_update_col,
+                                only_return_sql=False, binlog_gtid=binlog_gtid,
+                                update_to_replace=self.update_to_replace, keep_not_update_col=self.keep_not_update_col,
+                                filter_conditions=self.filter_conditions, rename_tb_dict=self.rename_tb_dict,
+                                add_comment=self.output_format == 'sql',
+                            )
+                            for row in binlog_event.rows
+                        )
+                    for sql, db, table in results:
                         try:
                             if sql:
                                 if self.need_comment != 1:
@@ -289,7 +382,9 @@ class Binlog2sql(object):
 
                                 if not self.flashback:
                                     if self.f_result_sql_file:
-                                        self.f_result_sql_file.write(sql + '\n')
+                                        self.f_result_sql_file.write(
+                                            self.format_result(sql, binlog_event, stream.log_file, e_start_pos, db,
+                                                               table, binlog_gtid) + '\n')
                                     elif self.table_per_file:
                                         if db and table:
                                             if self.date_prefix:
@@ -308,9 +403,8 @@ class Binlog2sql(object):
                                         result_sql_file = os.path.join(self.result_dir, filename)
                                         save_result_sql(result_sql_file, sql + '\n')
                                     elif sync_cursor:
-                                        sync_conn.ping(reconnect=True)
                                         try:
-                                            sync_cursor.execute(sql)
+                                            sync_applier.add(sql)
                                         except:
                                             logger.exception(f'Could not execute sql: {sql}')
                                             logger.error(
@@ -320,7 +414,8 @@ class Binlog2sql(object):
                                             exit_flag = 1
                                             break
                                     else:
-                                        print(sql)
+                                        print(self.format_result(sql, binlog_event, stream.log_file, e_start_pos, db,
+                                                                 table, binlog_gtid), flush=self.stream)
                                 else:
                                     if flashback_warn_flag == 1:
                                         logger.warning(
@@ -341,6 +436,14 @@ class Binlog2sql(object):
                 if flag_last_event:
                     break
 
+            if sync_applier:
+                # 停止位置落在事务中间时，已解析的语句同样提交
+                try:
+                    sync_applier.commit()
+                except Exception:
+                    logger.exception('Could not commit sync transaction')
+                finally:
+                    sync_applier.close()
             stream.close()
             f_tmp.close()
             if self.f_result_sql_file:
@@ -356,20 +459,21 @@ class Binlog2sql(object):
                 sync_conn.close()
         return True
 
+    def print_commit_marker(self, log_file, position, gtid):
+        self.executed_gtid_set = add_executed_gtid(self.executed_gtid_set, gtid)
+        print(commit_marker(log_file, position, gtid, self.executed_gtid_set, self.output_format), flush=True)
+
+    def format_result(self, sql, binlog_event, log_file, start_pos, db=None, table=None, binlog_gtid=None):
+        if self.output_format == 'json':
+            return event_to_json(sql, binlog_event, log_file, start_pos, db, table, binlog_gtid)
+        return sql
+
     def __del__(self):
         pass
 
 
-def main(args):
-    conn_setting = {
-        'host': args.host,
-        'port': args.port,
-        'user': args.user,
-        'passwd': args.password,
-        'charset': 'utf8mb4'
-    }
-
-    binlog2sql = Binlog2sql(
+def new_binlog2sql(args, conn_setting, **kwargs):
+    settings = dict(
         connection_settings=conn_setting, start_file=args.start_file, start_pos=args.start_pos,
         end_file=args.end_file, end_pos=args.end_pos, start_time=args.start_time,
         stop_time=args.stop_time, only_schemas=args.databases, only_tables=args.tables,
@@ -382,7 +486,111 @@ def main(args):
         result_file=args.result_file, result_dir=args.result_dir, date_prefix=args.date_prefix, args=args,
         include_gtids=args.include_gtids, exclude_gtids=args.exclude_gtids, update_to_replace=args.update_to_replace,
         keep_not_update_col=args.keep_not_update_col, chunk_size=args.chunk, tmp_dir=args.tmp_dir, where=args.where,
+        stream=args.stream, output_format=args.output_format, server_id=args.server_id,
+        server_id_range=args.server_id_range, batch_insert=args.batch_insert,
+        max_statement_size=args.max_statement_size, auto_position=args.auto_position,
+        gtid_markers=args.gtid_markers,
     )
+    settings.update(kwargs)
+    return Binlog2sql(**settings)
+
+
+catch_up_server_id = None
+
+
+def init_catch_up_worker(server_id_queue):
+    global catch_up_server_id
+    catch_up_server_id = server_id_queue.get()
+
+
+def catch_up_binlog_file(task):
+    """Decode one closed binlog file into a tmp result file, run in worker process"""
+    args, conn_setting, binlog_file, start_pos, end_pos, result_file = task
+    binlog2sql = new_binlog2sql(
+        args, conn_setting, start_file=binlog_file, start_pos=start_pos, end_file=binlog_file, end_pos=end_pos,
+        stop_never=False, stream=False, result_file=result_file, server_id=catch_up_server_id,
+    )
+    binlog2sql.process_binlog()
+    return binlog_file, result_file
+
+
+def catch_up(args, conn_setting):
+    """
+    Decode closed binlog files in parallel, and output them in file order.
+    Return (caught_up, finished), finished means there is nothing left for the normal (serial) process.
+    """
+    binlog2sql = new_binlog2sql(args, conn_setting)
+    binlog2i = lambda x: x.split('.')[1]
+    last_file = binlog2sql.eof_file if args.stop_never else binlog2sql.end_file
+    # 当前正在写入的 binlog 文件不参与并行解析
+    binlog_files = [f for f in binlog2sql.bin_index
+                    if binlog2i(args.start_file) <= binlog2i(f) <= binlog2i(last_file) and f != binlog2sql.eof_file]
+    binlog2sql.connection.close()
+    if len(binlog_files) < 2:
+        return False, False
+
+    # 每个 worker 进程以 --server-id-range 中不同的 server_id 注册为 slave，跳过流模式进程自身的 --server-id
+    workers = min(args.catch_up_workers, len(binlog_files))
+    id_min, id_max = parse_server_id_range(args.server_id_range)
+    server_ids = [i for i in range(id_min, id_max + 1) if i != args.server_id][:workers]
+    if len(server_ids) < workers:
+        raise ValueError('--server-id-range is too small for %s catch up workers' % workers)
+    server_id_queue = multiprocessing.Queue()
+    for server_id in server_ids:
+        server_id_queue.put(server_id)
+
+    tasks = []
+    for binlog_file in binlog_files:
+        start_pos = args.start_pos if binlog_file == args.start_file else 4
+        end_pos = args.end_pos if binlog_file == args.end_file else 0
+        result_file = create_unique_file('%s.catch_up' % binlog_file, args.tmp_dir)
+        tasks.append((args, conn_setting, binlog_file, start_pos, end_pos, result_file))
+
+    logger.info(f'Catching up {len(binlog_files)} binlog files with {workers} workers: '
+                f'[{binlog_files[0]} - {binlog_files[-1]}]')
+    f_result = open(args.result_file, 'w') if args.result_file else sys.stdout
+    try:
+        with multiprocessing.Pool(workers, initializer=init_catch_up_worker, initargs=(server_id_queue,)) as pool:
+            # imap 按提交顺序返回结果，保证输出仍按 binlog 文件顺序
+            for binlog_file, result_file in pool.imap(catch_up_binlog_file, tasks):
+                if args.stream:
+                    f_result.write(rotate_marker(binlog_file, 4, args.output_format) + '\n')
+                concat_result_files([result_file], f_result)
+                f_result.flush()
+    finally:
+        if args.result_file:
+            f_result.close()
+        for task in tasks:
+            if os.path.exists(task[-1]):
+                os.remove(task[-1])
+
+    next_files = [f for f in binlog2sql.bin_index if binlog2i(f) > binlog2i(binlog_files[-1])]
+    if not next_files or (not args.stop_never and binlog2i(last_file) <= binlog2i(binlog_files[-1])):
+        return True, True
+
+    args.start_file = next_files[0]
+    args.start_pos = 4
+    return True, False
+
+
+def main(args):
+    conn_setting = {
+        'host': args.host,
+        'port': args.port,
+        'user': args.user,
+        'passwd': args.password,
+        'charset': 'utf8mb4'
+    }
+
+    result_file_mode = 'w'
+    if args.catch_up_workers > 1:
+        caught_up, finished = catch_up(args, conn_setting)
+        if finished:
+            return
+        if caught_up:
+            result_file_mode = 'a'
+
+    binlog2sql = new_binlog2sql(args, conn_setting, result_file_mode=result_file_mode)
     binlog2sql.process_binlog()
 
 
@@ -2,18 +2,23 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import multiprocessing
 import os
 import sys
 import time
 import pymysql
 import re
-from utils.binlogfile2sql_util import command_line_args, BinLogFileReader
+from functools import partial
+from utils.binlogfile2sql_util import command_line_args, BinLogFileReader, load_binlog_index, binlog_index_seek, \
+    SchemaCache, offline_connection, export_schema_snapshot
 from utils.binlog2sql_util import concat_sql_from_binlog_event, is_dml_event, event_type, logger, set_log_format, \
     get_gtid_set, is_want_gtid, save_result_sql, dt_now, handle_rollback_sql, \
-    get_max_gtid, remove_max_gtid, connect2sync_mysql
-from pymysqlreplication.event import QueryEvent, RotateEvent, FormatDescriptionEvent, GtidEvent
+    get_max_gtid, remove_max_gtid, connect2sync_mysql, SyncApplier, ParallelSyncApplier, get_row_keys, \
+    concat_batch_insert_sql
+from pymysqlreplication.event import QueryEvent, RotateEvent, FormatDescriptionEvent, GtidEvent, XidEvent
+from pymysqlreplication.row_event import WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent
 from utils.other_utils import create_unique_file, temp_open, get_binlog_file_list, timestamp_to_datetime, \
-    save_executed_result, split_condition, merge_rename_args
+    save_executed_result, split_condition, merge_rename_args, concat_result_files
 
 sep = '/' if '/' in sys.argv[0] else os.sep
 
@@ -26,7 +31,8 @@ class BinlogFile2sql(object):
                  ignore_databases=None, ignore_tables=None, ignore_columns=None, replace=False, rename_tb=None,
                  ignore_virtual_columns=False, file_index=0, remove_not_update_col=False, date_prefix=False,
                  include_gtids=None, exclude_gtids=None, update_to_replace=False, no_date=False,
-                 keep_not_update_col: list = None, chunk_size=1000, tmp_dir='tmp', where=None, args=None):
+                 keep_not_update_col: list = None, chunk_size=1000, tmp_dir='tmp', where=None, args=None,
+                 use_index=True, schema_cache=None, batch_insert=False, max_statement_size=1048576):
         """
         connection_settings: {'host': 127.0.0.1, 'port': 3306, 'user': slave, 'passwd': slave}
         """
@@ -50,7 +56,10 @@ class BinlogFile2sql(object):
         self.sql_type = [t.upper() for t in sql_type] if sql_type else []
 
         self.binlog_file_list = []
-        self.connection = pymysql.connect(**self.connection_settings)
+        if schema_cache is not None and schema_cache.offline:
+            self.connection = offline_connection(self.connection_settings)
+        else:
+            self.connection = pymysql.connect(**self.connection_settings)
 
         self.result_dir = result_dir
         self.need_comment = need_comment
@@ -65,6 +74,8 @@ class BinlogFile2sql(object):
         self.ignore_columns = ignore_columns if ignore_columns is not None else []
         self.replace = replace
         self.insert_ignore = insert_ignore
+        self.batch_insert = batch_insert
+        self.max_statement_size = max_statement_size
         self.ignore_virtual_columns = ignore_virtual_columns
         self.file_index = file_index
         self.remove_not_update_col = remove_not_update_col
@@ -93,12 +104,36 @@ class BinlogFile2sql(object):
                             self.keep_not_update_col.append(cond_column)
 
         self.args = args
+        self.use_index = use_index
+        self.schema_cache = schema_cache
+        self.start_time_given = start_time is not None
+
+    def get_seek_pos(self):
+        """Offset the reader could jump to by the binlog index, skip events before --start-pos,
+        --start-datetime and --include-gtid without parsing them"""
+        start_ts = self.start_time.timestamp() if self.start_time_given and not self.stop_never else None
+        if not self.use_index or (self.start_pos <= 4 and start_ts is None and not self.gtid_set):
+            return 4
+        try:
+            index = load_binlog_index(self.file_path, os.path.join(self.tmp_dir, 'binlog_index'))
+        except Exception as e:
+            logger.warning(f'Could not build binlog index of {self.file_path}, parse from the beginning: {e}')
+            return 4
+        return binlog_index_seek(index, self.start_pos, start_ts, self.gtid_set)
 
     def process_binlog(self):
+        seek_pos = self.get_seek_pos()
+        if seek_pos > 4:
+            logger.info(f'Seek to pos {seek_pos} of binlog file {self.file_path} by binlog index')
+        # 不需要的 sql type 对应的 rows event 在 reader 里按 header 直接跳过
+        ignored_events = [e for e, t in ((WriteRowsEvent, 'INSERT'), (UpdateRowsEvent, 'UPDATE'),
+                                         (DeleteRowsEvent, 'DELETE')) if t not in self.sql_type]
         stream = BinLogFileReader(self.file_path, ctl_connection_settings=self.connection_settings,
                                   log_pos=self.start_pos, only_schemas=self.only_schemas, stop_pos=self.end_pos,
                                   only_tables=self.only_tables, ignored_schemas=self.ignore_databases,
-                                  ignored_tables=self.ignore_tables, ignore_virtual_columns=self.ignore_virtual_columns)
+                                  ignored_tables=self.ignore_tables, ignore_virtual_columns=self.ignore_virtual_columns,
+                                  seek_pos=seek_pos, ignored_events=ignored_events or None,
+                                  schema_cache=self.schema_cache)
         result_sql_file = ''
         if self.stop_never and not self.table_per_file:
             result_sql_file = self.file_path.split(sep)[-1].replace('.', '_').replace('-', '_') + '.sql'
@@ -120,16 +155,22 @@ class BinlogFile2sql(object):
         binlog_gtid = ''
         gtid_set = True if self.gtid_set else False
         flag_last_event = False
-        e_start_pos, last_pos = stream.log_pos, stream.log_pos
+        # 跳过的事件不再经过下面的循环，last_pos 直接从跳转位置开始
+        e_start_pos = last_pos = max(stream.log_pos, seek_pos)
         tmp_file = create_unique_file('%s.%s' % (self.connection_settings['host'], self.connection_settings['port']))
         tmp_file = os.path.join(self.tmp_dir, tmp_file)
 
         sync_conn = ''
         sync_cursor = ''
+        sync_applier = None
         with temp_open(tmp_file, "w") as f_tmp, self.connection.cursor() as cursor:
             if self.args and self.args.sync:
                 sync_conn = connect2sync_mysql(self.args)
                 sync_cursor = sync_conn.cursor()
+                if self.args.sync_workers > 1:
+                    sync_applier = ParallelSyncApplier(partial(connect2sync_mysql, self.args), self.args.sync_workers)
+                else:
+                    sync_applier = SyncApplier(sync_conn)
             for binlog_event in stream:
                 if not self.stop_never:
                     try:
@@ -150,6 +191,19 @@ class BinlogFile2sql(object):
                 if isinstance(binlog_event, QueryEvent) and binlog_event.query == 'BEGIN':
                     e_start_pos = last_pos
 
+                # 同步模式下，源事务结束时提交目标事务
+                if sync_applier and (isinstance(binlog_event, XidEvent) or
+                                     (isinstance(binlog_event, QueryEvent) and binlog_event.query == 'COMMIT')):
+                    try:
+                        sync_applier.commit()
+                    except Exception:
+                        logger.exception('Could not commit sync transaction')
+                        logger.error(
+                            f'Exit at binlog file {stream.log_file} '
+                            f'start pos {e_start_pos} end pos {binlog_event.packet.log_pos}'
+                        )
+                        break
+
                 if isinstance(binlog_event, GtidEvent):
                     binlog_gtid = str(binlog_event.gtid)
                     if self.gtid_max_dict:
@@ -198,11 +252,10 @@ class BinlogFile2sql(object):
                                 result_sql_file = os.path.join(self.result_dir, filename)
                                 save_result_sql(result_sql_file, sql + '\n')
                             elif sync_cursor:
-                                sync_conn.ping(reconnect=True)
                                 if re.match('USE .*;\n', sql) is not None:
                                     sql = re.sub('USE .*;\n', '', sql)
                                 try:
-                                    sync_cursor.execute(sql)
+                                    sync_applier.execute(sql)
                                 except:
                                     logger.exception(f'Could not execute sql: {sql}')
                                     logger.error(
@@ -221,20 +274,35 @@ class BinlogFile2sql(object):
                             f_tmp.write(sql + '\n')
                 elif is_dml_event(binlog_event) and event_type(binlog_event) in self.sql_type:
                     exit_flag = 0
-                    for row in binlog_event.rows:
-                        if binlog_gtid and gtid_set and not is_want_gtid(self.gtid_set, binlog_gtid):
-                            continue
-
-                        sql, db, table = concat_sql_from_binlog_event(
-                            cursor=cursor, binlog_event=binlog_event, row=row, flashback=self.flashback,
-                            e_start_pos=e_start_pos, rename_db_dict=self.rename_db_dict, only_pk=self.only_pk,
-                            only_return_sql=False, ignore_columns=self.ignore_columns, replace=self.replace,
+                    if isinstance(sync_applier, ParallelSyncApplier):
+                        sync_applier.add_keys(get_row_keys(binlog_event))
+                    # gtid 过滤按事件判断一次即可
+                    if binlog_gtid and gtid_set and not is_want_gtid(self.gtid_set, binlog_gtid):
+                        results = []
+                    elif self.batch_insert and not self.flashback and isinstance(binlog_event, WriteRowsEvent):
+                        results = concat_batch_insert_sql(
+                            cursor, binlog_event, binlog_event.rows, e_start_pos=e_start_pos,
+                            max_statement_size=self.max_statement_size, no_pk=self.no_pk,
+                            rename_db_dict=self.rename_db_dict, rename_tb_dict=self.rename_tb_dict,
+                            ignore_columns=self.ignore_columns, replace=self.replace,
                             insert_ignore=self.insert_ignore, ignore_virtual_columns=self.ignore_virtual_columns,
-                            remove_not_update_col=self.remove_not_update_col, binlog_gtid=binlog_gtid,
-                            update_to_replace=self.update_to_replace, keep_not_update_col=self.keep_not_update_col,
-                            filter_conditions=self.filter_conditions, no_pk=self.no_pk,
-                            rename_tb_dict=self.rename_tb_dict,
+                            binlog_gtid=binlog_gtid, filter_conditions=self.filter_conditions,
                         )
+                    else:
+                        results = (
+                            concat_sql_from_binlog_event(
+                                cursor=cursor, binlog_event=binlog_event, row=row, flashback=self.flashback,
+                                e_start_pos=e_start_pos, rename_db_dict=self.rename_db_dict, only_pk=self.only_pk,
+                                only_return_sql=False, ignore_columns=self.ignore_columns, replace=self.replace,
+                                insert_ignore=self.insert_ignore, ignore_virtual_columns=self.ignore_virtual_columns,
+                                remove_not_update_col=self.remove_not_update_col, binlog_gtid=binlog_gtid,
+                                update_to_replace=self.update_to_replace, keep_not_update_col=self.keep_not_update_col,
+                                filter_conditions=self.filter_conditions, no_pk=self.no_pk,
+                                rename_tb_dict=self.rename_tb_dict,
+                            )
+                            for row in binlog_event.rows
+                        )
+                    for sql, db, table in results:
                         if sql:
                             if self.need_comment != 1:
                                 sql = re.sub('; #.*', ';', sql)
@@ -261,9 +329,8 @@ class BinlogFile2sql(object):
                                     result_sql_file = os.path.join(self.result_dir, filename)
                                     save_result_sql(result_sql_file, sql + '\n')
                                 elif sync_cursor:
-                                    sync_conn.ping(reconnect=True)
                                     try:
-                                        sync_cursor.execute(sql)
+                                        sync_applier.add(sql)
                                     except:
                                         logger.exception(f'Could not execute sql: {sql}')
                                         logger.error(
@@ -290,8 +357,18 @@ class BinlogFile2sql(object):
                 if flag_last_event:
                     break
 
+            if sync_applier:
+                # 停止位置落在事务中间时，已解析的语句同样提交
+                try:
+                    sync_applier.commit()
+                except Exception:
+                    logger.exception('Could not commit sync transaction')
+                finally:
+                    sync_applier.close()
             stream.close()
             f_tmp.close()
+            if self.schema_cache is not None:
+                self.schema_cache.save()
             if self.f_result_sql_file:
                 self.f_result_sql_file.close()
 
@@ -309,8 +386,101 @@ class BinlogFile2sql(object):
         pass
 
 
+def new_schema_cache(args, persist=True):
+    if args.schema_snapshot:
+        return SchemaCache(args.schema_snapshot, ignore_virtual_columns=args.ignore_virtual_columns, offline=True)
+    return SchemaCache(args.schema_cache_file, source=f'{args.host}:{args.port}',
+                       ignore_virtual_columns=args.ignore_virtual_columns, persist=persist)
+
+
+def new_binlogfile2sql(args, connection_settings, binlog_file, **kwargs):
+    settings = dict(
+        file_path=binlog_file, connection_settings=connection_settings, start_pos=args.start_pos,
+        end_pos=args.end_pos, start_time=args.start_time, stop_time=args.stop_time,
+        only_schemas=args.databases, result_dir=args.result_dir, only_tables=args.tables, no_pk=args.no_pk,
+        flashback=args.flashback, only_dml=args.only_dml, sql_type=args.sql_type,
+        stop_never=args.stop_never, need_comment=args.need_comment, rename_db=args.rename_db,
+        only_pk=args.only_pk, result_file=args.result_file, table_per_file=args.table_per_file,
+        ignore_databases=args.ignore_databases, ignore_tables=args.ignore_tables, rename_tb=args.rename_tb,
+        ignore_columns=args.ignore_columns, replace=args.replace, insert_ignore=args.insert_ignore,
+        ignore_virtual_columns=args.ignore_virtual_columns, date_prefix=args.date_prefix,
+        remove_not_update_col=args.remove_not_update_col, no_date=args.no_date,
+        include_gtids=args.include_gtids, exclude_gtids=args.exclude_gtids, tmp_dir=args.tmp_dir,
+        update_to_replace=args.update_to_replace, keep_not_update_col=args.keep_not_update_col,
+        chunk_size=args.chunk, where=args.where, args=args, use_index=not args.no_binlog_index,
+        batch_insert=args.batch_insert, max_statement_size=args.max_statement_size,
+    )
+    settings.update(kwargs)
+    return BinlogFile2sql(**settings)
+
+
+worker_schema_cache = None
+
+
+def decode_binlog_file(task):
+    """Decode one binlog file into its own result file, run in worker process"""
+    global worker_schema_cache
+    args, connection_settings, binlog_file, start_pos, end_pos, result_file = task
+    if worker_schema_cache is None:
+        # 多个 worker 进程各自持有缓存，只读取缓存文件，避免互相覆盖
+        worker_schema_cache = new_schema_cache(args, persist=False)
+    logger.info('parsing binlog file: %s [%s]' %
+                (binlog_file, timestamp_to_datetime(os.stat(binlog_file).st_mtime)))
+    bin2sql = new_binlogfile2sql(args, connection_settings, binlog_file, start_pos=start_pos, end_pos=end_pos,
+                                 result_file=result_file, file_index=0, schema_cache=worker_schema_cache)
+    r = bin2sql.process_binlog()
+    return binlog_file, result_file, r
+
+
+def process_in_workers(args, connection_settings, binlog_file_list, executed_file_list):
+    """
+    Decode binlog files in args.workers processes, and output them in file order.
+    With --stop-never every binlog file has its own result file already, otherwise the per-file results are
+    concatenated into --result-file or stdout.
+    """
+    if not os.path.exists(args.tmp_dir):
+        os.makedirs(args.tmp_dir, exist_ok=True)
+    tasks = []
+    for i, binlog_file in enumerate(binlog_file_list):
+        if i == 0 and binlog_file == args.start_file:
+            start_pos, end_pos = args.start_pos, args.end_pos
+        else:
+            start_pos, end_pos = None, None
+        result_file = None if args.stop_never else \
+            create_unique_file('%s.result' % binlog_file.split(sep)[-1], args.tmp_dir)
+        tasks.append((args, connection_settings, binlog_file, start_pos, end_pos, result_file))
+
+    workers = min(args.workers, len(tasks))
+    logger.info(f'Parsing {len(tasks)} binlog files with {workers} workers')
+    if not args.stop_never and args.result_file:
+        logger.info(f'Saving result into file: [{args.result_file}]')
+    f_result = open(args.result_file, 'w') if args.result_file and not args.stop_never else sys.stdout
+    try:
+        with multiprocessing.Pool(workers) as pool:
+            # imap 按提交顺序返回结果，保证输出仍按 binlog 文件顺序
+            for binlog_file, result_file, r in pool.imap(decode_binlog_file, tasks):
+                if args.stop_never:
+                    if r is True:
+                        executed_file_list.append(binlog_file)
+                        save_executed_result(args.record_file, executed_file_list)
+                    continue
+                concat_result_files([result_file], f_result)
+                f_result.flush()
+    finally:
+        if f_result is not sys.stdout:
+            f_result.close()
+        for task in tasks:
+            if task[-1] and os.path.exists(task[-1]):
+                os.remove(task[-1])
+
+
 def main(args):
     connection_settings = {'host': args.host, 'port': args.port, 'user': args.user, 'passwd': args.password}
+    if args.export_schema_snapshot:
+        n = export_schema_snapshot(connection_settings, args.export_schema_snapshot, args.databases)
+        logger.info(f'Exported columns of {n} tables into schema snapshot: [{args.export_schema_snapshot}]')
+        return
+
     binlog_file_list, executed_file_list = get_binlog_file_list(args)
 
     if args.check:
@@ -332,28 +502,21 @@ def main(args):
         if choice in ['y', '']:
             args.only_dml = True
 
+    schema_cache = new_schema_cache(args)
     while True:
+        if args.workers > 1 and len(binlog_file_list) > 1:
+            process_in_workers(args, connection_settings, binlog_file_list, executed_file_list)
+            binlog_file_list = []
+            args.start_pos = None
+            args.end_pos = None
         for i, binlog_file in enumerate(binlog_file_list):
             if not (i == 0 and binlog_file == args.start_file):
                 args.start_pos = None
                 args.end_pos = None
             logger.info('parsing binlog file: %s [%s]' %
                         (binlog_file, timestamp_to_datetime(os.stat(binlog_file).st_mtime)))
-            bin2sql = BinlogFile2sql(
-                file_path=binlog_file, connection_settings=connection_settings, start_pos=args.start_pos,
-                end_pos=args.end_pos, start_time=args.start_time, stop_time=args.stop_time,
-                only_schemas=args.databases, result_dir=args.result_dir, only_tables=args.tables, no_pk=args.no_pk,
-                flashback=args.flashback, only_dml=args.only_dml, sql_type=args.sql_type, file_index=i,
-                stop_never=args.stop_never, need_comment=args.need_comment, rename_db=args.rename_db,
-                only_pk=args.only_pk, result_file=args.result_file, table_per_file=args.table_per_file,
-                ignore_databases=args.ignore_databases, ignore_tables=args.ignore_tables, rename_tb=args.rename_tb,
-                ignore_columns=args.ignore_columns, replace=args.replace, insert_ignore=args.insert_ignore,
-                ignore_virtual_columns=args.ignore_virtual_columns, date_prefix=args.date_prefix,
-                remove_not_update_col=args.remove_not_update_col, no_date=args.no_date,
-                include_gtids=args.include_gtids, exclude_gtids=args.exclude_gtids, tmp_dir=args.tmp_dir,
-                update_to_replace=args.update_to_replace, keep_not_update_col=args.keep_not_update_col,
-                where=args.where, args=args,
-            )
+            bin2sql = new_binlogfile2sql(args, connection_settings, binlog_file, file_index=i,
+                                         schema_cache=schema_cache)
             r = bin2sql.process_binlog()
             if not args.stop_never:
                 continue
@@ -6,14 +6,24 @@ import re
 import sys
 import argparse
 import datetime
+import decimal
 import getpass
 import json
 import logging
+import queue
+import socket
+import threading
+import time
+import zlib
 import chardet
 import colorlog
 import pymysql
-from functools import partial
-from pymysqlreplication.event import QueryEvent
+from pymysql.constants import CLIENT
+from bisect import bisect_right
+from functools import lru_cache
+from pymysqlreplication import BinLogStreamReader
+from pymysqlreplication.event import QueryEvent, RotateEvent, GtidEvent, PreviousGtidsEvent
+from pymysqlreplication.gtid import Gtid, GtidSet
 from pymysqlreplication.row_event import (
     WriteRowsEvent,
     UpdateRowsEvent,
@@ -99,6 +109,13 @@ def extend_parser(parser, is_binlog_file=False):
                                  help='MySQL Password to use', default='')
     connect_setting.add_argument('-P', '--port', dest='port', type=int,
                                  help='MySQL port to use', default=3306)
+    if not is_binlog_file:
+        connect_setting.add_argument('--server-id', dest='server_id', type=int, default=0,
+                                     help="Server id to register as replica. default: pick one from "
+                                          "--server-id-range, or use @@server_id of the source")
+        connect_setting.add_argument('--server-id-range', dest='server_id_range', type=str, default='',
+                                     help="Range of server id like 1000-1999. A server id is picked from it by "
+                                          "hostname, pid and --start-file, so that parallel readers won't conflict")
 
     schema = parser.add_argument_group('schema filter')
     schema.add_argument('-d', '--databases', dest='databases', type=str, nargs='*',
@@ -142,6 +159,15 @@ def extend_parser(parser, is_binlog_file=False):
         interval.add_argument('--start-file', dest='start_file', type=str, help='Start binlog file to be parsed')
         interval.add_argument('--stop-file', '--end-file', dest='end_file', type=str,
                               help="Stop binlog file to be parsed. default: '--start-file'", default='')
+        interval.add_argument('--auto-position', dest='auto_position', type=str, default='',
+                              help="Executed GTID set like uuid:1-100[,uuid:1-20]. Start from the first transaction "
+                                   "not in it instead of --start-file/--start-pos, like MASTER_AUTO_POSITION. "
+                                   "With --stream, a '# commit <file> <pos> <executed_gtid_set>' line is printed "
+                                   "after every transaction, pass its gtid set here to resume.")
+        interval.add_argument('--gtid-markers', dest='gtid_markers', action='store_true', default=False,
+                              help="With --stream and --start-file/--start-pos, print the '# commit' lines of "
+                                   "--auto-position too. The executed GTID set starts from the GTIDs before "
+                                   "--start-pos, read from the head of --start-file.")
 
     event = parser.add_argument_group('event filter')
     event.add_argument('--only-dml', dest='only_dml', action='store_true', default=False,
@@ -150,6 +176,14 @@ def extend_parser(parser, is_binlog_file=False):
                        help='Sql type you want to process, support INSERT, UPDATE, DELETE.')
     event.add_argument('--stop-never', dest='stop_never', action='store_true', default=False,
                        help="Continuously parse binlog. default: stop at the latest event when you start.")
+    if not is_binlog_file:
+        event.add_argument('--catch-up-workers', dest='catch_up_workers', type=int, default=0,
+                           help="Decode closed binlog files from --start-file on in N parallel processes, then "
+                                "output them in file order. Only works with stdout or --result-file output. "
+                                "Needs --server-id-range, every worker uses a server id of it.")
+        event.add_argument('--stream', dest='stream', action='store_true', default=False,
+                           help="Keep one replication stream open and print events as soon as they arrive, "
+                                "with a '# rotate <file> <pos>' line on every binlog rotation. Implies --stop-never.")
 
     # exclusive = parser.add_mutually_exclusive_group()
     event.add_argument('-K', '--no-primary-key', dest='no_pk', action='store_true',
@@ -200,6 +234,17 @@ def extend_parser(parser, is_binlog_file=False):
                              'default: ${db}.${tb}_${date}.sql')
     result.add_argument('--where', dest='where', type=str, nargs='*',
                         help='filter result by specify conditions.')
+    result.add_argument('--batch-insert', dest='batch_insert', action='store_true', default=False,
+                        help='If set, rows of one insert event are merged into multi-row INSERT/REPLACE statements '
+                             'bounded by --max-statement-size. Ignored with --flashback.')
+    result.add_argument('--max-statement-size', dest='max_statement_size', type=int, default=1048576,
+                        help='Max bytes of one statement generated by --batch-insert. default: 1048576')
+    if not is_binlog_file:
+        result.add_argument('--output-format', dest='output_format', type=str, choices=['sql', 'json'],
+                            default='sql',
+                            help='Format of result printed to stdout or saved in --result-file. json prints one '
+                                 'object per line with sql, db, table, type, binlog_file, start, end, gtid, '
+                                 'timestamp and time fields.')
 
     sync_connect_setting = parser.add_argument_group('sync connect setting')
     sync_connect_setting.add_argument('--sync', dest='sync', action='store_true', default=False,
@@ -216,6 +261,12 @@ def extend_parser(parser, is_binlog_file=False):
                                       help='MySQL Database for sync binlog', default='information_schema')
     sync_connect_setting.add_argument('-sC', '--sync-charset', dest='sync_charset', type=str,
                                       help='MySQL charset for sync binlog', default='utf8mb4')
+    sync_connect_setting.add_argument('--sync-workers', dest='sync_workers', type=int, default=1,
+                                      help='Apply transactions on N connections in parallel. Transactions touching '
+                                           'the same table and primary key go to the same connection; DDL and '
+                                           'transactions across connections wait for all connections. '
+                                           'Since later transactions may be applied before a failed one, use '
+                                           '--replace if you rerun after an error. default: 1')
     return
 
 
@@ -236,12 +287,29 @@ def command_line_args(args):
         logger.warning('we will ignore path if give a result file with relative path or absolute path, '
                        'please use --result-dir to set path.')
 
-    if not args.start_file:
+    if not args.start_file and not args.auto_position:
         raise ValueError('Lack of parameter: start_file')
+    if args.auto_position:
+        try:
+            GtidSet(args.auto_position)
+        except Exception:
+            raise ValueError('Invalid gtid set of --auto-position: %s' % args.auto_position)
+    if args.stream:
+        args.stop_never = True
+    if (args.auto_position or args.gtid_markers) and (args.flashback or args.catch_up_workers > 1):
+        raise ValueError('--auto-position and --gtid-markers do not work with --flashback or --catch-up-workers')
     if args.flashback and args.stop_never:
         raise ValueError('Only one of flashback or stop-never can be True')
     if args.flashback and args.no_pk:
         raise ValueError('Only one of flashback or no_pk can be True')
+    if args.catch_up_workers > 1 and (args.flashback or args.sync or args.table_per_file):
+        raise ValueError('--catch-up-workers only works with stdout or --result-file output')
+    if args.catch_up_workers > 1 and not args.server_id_range:
+        raise ValueError('--catch-up-workers needs --server-id-range to register every worker with its own server id')
+    if args.max_statement_size < 1:
+        raise ValueError('--max-statement-size must be greater than 0')
+    if args.sync_workers < 1:
+        raise ValueError('--sync-workers must be greater than 0')
     if (args.start_time and not is_valid_datetime(args.start_time)) or \
             (args.stop_time and not is_valid_datetime(args.stop_time)):
         raise ValueError('Incorrect datetime argument')
@@ -278,11 +346,17 @@ def fix_object_bytes(value: bytes, is_bytes_column: bool = True):
         value = '0x' + value.hex().upper()
         return value
 
+    # json 内的字符串固定为 utf8mb4，先按 utf8 解码，失败才用 chardet 检测
+    try:
+        return value.decode('utf8')
+    except Exception:
+        pass
+
     try:
-        encoding = chardet.detect(value).get('encoding', '')
-        if not encoding:
-            encoding = 'utf8'
-        return value.decode(encoding)
+        detected_encoding = chardet.detect(value).get('encoding', '')
+        if not detected_encoding:
+            detected_encoding = 'utf8'
+        return value.decode(detected_encoding)
     except Exception:
         value = '0x' + value.hex().upper()
         return value
@@ -346,6 +420,31 @@ def fix_object(value, is_return_type: bool = False):
         return value
 
 
+# fix_object 原样返回的类型，逐行转换时直接跳过类型判断
+PLAIN_VALUE_TYPES = frozenset([int, float, str, type(None), decimal.Decimal, datetime.datetime, datetime.date,
+                               datetime.time, datetime.timedelta])
+
+
+def convert_row_values(*values_list):
+    """
+    Fix values of one or more rows (e.g. SET values then WHERE values) in a single pass, returning the fixed values
+    together with the original types, same as map(fix_object) plus map(fix_object, is_return_type=True).
+    """
+    values = []
+    types = []
+    append_value = values.append
+    append_type = types.append
+    for row_values in values_list:
+        for value in row_values:
+            value_type = type(value)
+            append_type(value_type)
+            if value_type in PLAIN_VALUE_TYPES:
+                append_value(value)
+            else:
+                append_value(fix_object(value))
+    return values, types
+
+
 def is_dml_event(event):
     if isinstance(event, WriteRowsEvent) or isinstance(event, UpdateRowsEvent) or isinstance(event, DeleteRowsEvent):
         return True
@@ -364,54 +463,37 @@ def event_type(event):
     return t
 
 
-def handle_list(value: list):
-    new_list = []
-    for v in value:
-        if isinstance(v, dict) or isinstance(v, list):
+def render_sql_values(connection, values: list, types: list):
+    """
+    Render fixed values into SQL literals by their original types in one pass: bytes are hex literals already
+    (fix_object_bytes), dict and list are dumped to json strings, others are escaped like cursor.mogrify does.
+    """
+    literals = []
+    for value, value_type in zip(values, types):
+        if value_type is bytes and isinstance(value, str):
+            # 空 bytes 不能写成 0x
+            literals.append(value if value != '0x' else "''")
+        elif value is None:
+            literals.append('NULL')
+        elif isinstance(value, str):
+            literals.append("'" + connection.escape_string(value) + "'")
+        elif isinstance(value, (dict, list)):
             try:
-                v = json.dumps(v, ensure_ascii=False)
+                literals.append("'" + connection.escape_string(json.dumps(value, ensure_ascii=False)) + "'")
             except Exception as e:
                 logger.error("Failed to dump dict or list value to string. Error is:" + str(e))
-                logger.error("Error value is:" + str(v))
+                logger.error("Error value is:" + str(value))
                 sys.exit(1)
-        new_list.append(v)
-    return new_list
-
-
-def fix_hex_values(sql: str, values: list, types: list):
-    begin = 0
-    new_sql = ''
-    while sql.find("'0x", begin) > 0:
-        # 拿第1个引号的下标
-        quote_begin_idx = sql.find("'0x", begin)
-        # 拿第2个引号的下标
-        quote_end_idx = sql.find("'", quote_begin_idx + 1)
-        # 获取 0x 开头的值
-        quote_value = sql[quote_begin_idx + 1:quote_end_idx]
-
-        # 确认 0x 开头的值是十六进制的值，还是字符串
-        quote_value_idx = values.index(quote_value)
-        quote_value_type = types[quote_value_idx]
-        if quote_value_type == str:
-            # 保留原样
-            new_sql += sql[begin:quote_end_idx + 1]
         else:
-            # 去除 十六进制值 前后的引号
-            new_sql += sql[begin:quote_begin_idx] + sql[quote_begin_idx + 1:quote_end_idx]
-
-        begin = quote_end_idx + 1
-
-    if new_sql:
-        new_sql += sql[quote_end_idx + 1:]
-
-    return new_sql
+            literals.append(connection.literal(value))
+    return tuple(literals)
 
 
 def concat_sql_from_binlog_event(cursor, binlog_event, row=None, e_start_pos=None, flashback=False, no_pk=False,
                                  rename_db_dict=None, rename_tb_dict=None, only_pk=False, only_return_sql=True,
                                  ignore_columns=None, replace=False, insert_ignore=False, ignore_virtual_columns=False,
                                  remove_not_update_col=False, binlog_gtid=None, update_to_replace=False,
-                                 keep_not_update_col: list = None, filter_conditions: list = None):
+                                 keep_not_update_col: list = None, filter_conditions: list = None, add_comment=True):
     if flashback and no_pk:
         raise ValueError('only one of flashback or no_pk can be True')
     if not (isinstance(binlog_event, WriteRowsEvent) or isinstance(binlog_event, UpdateRowsEvent)
@@ -433,18 +515,12 @@ def concat_sql_from_binlog_event(cursor, binlog_event, row=None, e_start_pos=Non
         )
 
         if pattern['values']:
-            # cursor.mogrify 处理 value 时，会返回一个字符串，如果 value 里包含 dict，则会报错
-            if isinstance(pattern['values'], list):
-                pattern_values = handle_list(pattern['values'])
-            else:
-                pattern_values = pattern['values']
-            sql = cursor.mogrify(pattern['template'], pattern_values)
-            if "'0x" in str(sql):
-                sql = fix_hex_values(sql, pattern_values, types)
-            time = datetime.datetime.fromtimestamp(binlog_event.timestamp)
-            sql += ' #start %s end %s time %s' % (e_start_pos, binlog_event.packet.log_pos, time)
-            if binlog_gtid:
-                sql += ' gtid %s' % binlog_gtid
+            sql = pattern['template'] % render_sql_values(cursor.connection, pattern['values'], types)
+            if add_comment:
+                time = datetime.datetime.fromtimestamp(binlog_event.timestamp)
+                sql += ' #start %s end %s time %s' % (e_start_pos, binlog_event.packet.log_pos, time)
+                if binlog_gtid:
+                    sql += ' gtid %s' % binlog_gtid
     elif flashback is False and isinstance(binlog_event, QueryEvent) and binlog_event.query != 'BEGIN' \
             and binlog_event.query != 'COMMIT':
         sql = '{0};'.format(fix_object(binlog_event.query))
@@ -464,6 +540,54 @@ def concat_sql_from_binlog_event(cursor, binlog_event, row=None, e_start_pos=Non
         return sql
 
 
+def concat_batch_insert_sql(cursor, binlog_event, rows, e_start_pos=None, max_statement_size=1048576, no_pk=False,
+                            rename_db_dict=None, rename_tb_dict=None, ignore_columns=None, replace=False,
+                            insert_ignore=False, ignore_virtual_columns=False, binlog_gtid=None,
+                            filter_conditions: list = None, add_comment=True):
+    """
+    Merge rows of one WriteRowsEvent into multi-row INSERT/REPLACE statements, each at most max_statement_size
+    bytes unless a single row is larger. Yields (sql, db, table) like concat_sql_from_binlog_event.
+    """
+    if not isinstance(binlog_event, WriteRowsEvent):
+        raise ValueError('binlog_event must be WriteRowsEvent')
+
+    comment = ''
+    if add_comment:
+        time = datetime.datetime.fromtimestamp(binlog_event.timestamp)
+        comment = ' #start %s end %s time %s' % (e_start_pos, binlog_event.packet.log_pos, time)
+        if binlog_gtid:
+            comment += ' gtid %s' % binlog_gtid
+
+    head = ''
+    batch = []
+    batch_size = 0
+    db = table = ''
+    for row in rows:
+        (pattern, db, table), types = generate_sql_pattern(
+            binlog_event, row=row, no_pk=no_pk, rename_db_dict=rename_db_dict, rename_tb_dict=rename_tb_dict,
+            ignore_columns=ignore_columns, replace=replace, insert_ignore=insert_ignore, return_type=True,
+            ignore_virtual_columns=ignore_virtual_columns, filter_conditions=filter_conditions,
+        )
+        if not pattern['values']:
+            continue
+
+        # 模板形如 INSERT INTO `db`.`tb`(`c1`, `c2`) VALUES (%s, %s);
+        row_head = pattern['template'][:pattern['template'].rindex(' VALUES (') + len(' VALUES ')]
+        row_values = '(' + ', '.join(render_sql_values(cursor.connection, pattern['values'], types)) + ')'
+        row_values_size = len(row_values.encode('utf8'))
+        if batch and (row_head != head or batch_size + row_values_size + 2 > max_statement_size):
+            yield head + ', '.join(batch) + ';' + comment, db, table
+            batch = []
+        if not batch:
+            head = row_head
+            batch_size = len(head.encode('utf8')) + 1
+        batch.append(row_values)
+        batch_size += row_values_size + 2
+
+    if batch:
+        yield head + ', '.join(batch) + ';' + comment, db, table
+
+
 def check_condition_match_row(filter_conditions, values, check_match_flag):
     for cond_elem in filter_conditions:
         # 校验单个条件
@@ -518,6 +642,28 @@ def check_condition_match_row(filter_conditions, values, check_match_flag):
     return check_match_flag
 
 
+def event_to_json(sql, binlog_event, log_file, start_pos, db=None, table=None, binlog_gtid=None):
+    """Dump one result as a json line, so that callers needn't parse the sql comment"""
+    if isinstance(binlog_event, RotateEvent):
+        return rotate_marker(binlog_event.next_binlog, binlog_event.position, 'json')
+
+    if not db and isinstance(binlog_event, QueryEvent) and binlog_event.schema:
+        db = binlog_event.schema.decode('utf8') if isinstance(binlog_event.schema, bytes) else binlog_event.schema
+    record = {
+        'sql': sql,
+        'db': db or '',
+        'table': table or '',
+        'type': event_type(binlog_event) or 'QUERY',
+        'binlog_file': log_file,
+        'start': start_pos,
+        'end': binlog_event.packet.log_pos,
+        'gtid': binlog_gtid or '',
+        'timestamp': binlog_event.timestamp,
+        'time': str(datetime.datetime.fromtimestamp(binlog_event.timestamp)),
+    }
+    return json.dumps(record, ensure_ascii=False)
+
+
 def get_pk_item(binlog_event, values):
     primary_keys = binlog_event.primary_key
     if not isinstance(primary_keys, tuple):
@@ -527,6 +673,33 @@ def get_pk_item(binlog_event, values):
     }
 
 
+def get_sql_template(statement, db, tb, set_item=None, where_item=None):
+    """
+    Template of statement for the columns of set_item (INSERT/REPLACE column list or UPDATE SET list) and
+    where_item (WHERE conditions, `col` IS %s for NULL values), cached by columns and NULL mask.
+    """
+    set_keys = tuple(set_item) if set_item is not None else ()
+    where_keys = tuple(where_item) if where_item is not None else ()
+    where_nulls = tuple(v is None for v in where_item.values()) if where_item is not None else ()
+    return build_sql_template(statement, db, tb, set_keys, where_keys, where_nulls)
+
+
+@lru_cache(maxsize=4096)
+def build_sql_template(statement, db, tb, set_keys, where_keys, where_nulls):
+    where = ' AND '.join(['`%s` IS %%s' % k if is_null else '`%s`=%%s' % k
+                          for k, is_null in zip(where_keys, where_nulls)])
+    if statement == 'DELETE':
+        return 'DELETE FROM `{0}`.`{1}` WHERE {2} LIMIT 1;'.format(db, tb, where)
+    elif statement == 'UPDATE':
+        return 'UPDATE `{0}`.`{1}` SET {2} WHERE {3} LIMIT 1;'.format(
+            db, tb, ', '.join(['`%s`=%%s' % k for k in set_keys]), where)
+    elif statement == 'REPLACE SET':
+        return 'REPLACE INTO `{0}`.`{1}` SET {2};'.format(db, tb, ', '.join(['`%s`=%%s' % k for k in set_keys]))
+    # INSERT, INSERT IGNORE, REPLACE
+    return '{0} INTO `{1}`.`{2}`({3}) VALUES ({4});'.format(
+        statement, db, tb, ', '.join(map(lambda key: '`%s`' % key, set_keys)), ', '.join(['%s'] * len(set_keys)))
+
+
 def generate_sql_pattern(binlog_event, row=None, flashback=False, no_pk=False, rename_db_dict=None, rename_tb_dict=None,
                          only_pk=False, ignore_columns=None, replace=False, insert_ignore=False,
                          ignore_virtual_columns=False, remove_not_update_col=False, return_type=False,
@@ -586,7 +759,6 @@ def generate_sql_pattern(binlog_event, row=None, flashback=False, no_pk=False, r
     types = []
     db = binlog_event.schema
     table = binlog_event.table
-    fix_object_new = partial(fix_object, is_return_type=True)
 
     if check_match_flag in [-1, 1]:
         specified_rename_db = rename_db_dict.get(binlog_event.schema) if rename_db_dict else ''
@@ -599,68 +771,22 @@ def generate_sql_pattern(binlog_event, row=None, flashback=False, no_pk=False, r
 
         if flashback is True:
             if isinstance(binlog_event, WriteRowsEvent):
-                if not only_pk:
-                    template = 'DELETE FROM `{0}`.`{1}` WHERE {2} LIMIT 1;'.format(
-                        db, tb,
-                        ' AND '.join(map(compare_items, row['values'].items()))
-                    )
-                    values = map(fix_object, row['values'].values())
-                    types = map(fix_object_new, row['values'].values())
-                else:
-                    pk_item = get_pk_item(binlog_event, row["values"])
-                    template = 'DELETE FROM `{0}`.`{1}` WHERE {2} LIMIT 1;'.format(
-                        db, tb,
-                        ' AND '.join(map(compare_items, pk_item.items()))
-                    )
-                    values = map(fix_object, pk_item.values())
-                    types = map(fix_object_new, row['values'].values())
+                where_item = row['values'] if not only_pk else get_pk_item(binlog_event, row['values'])
+                template = get_sql_template('DELETE', db, tb, where_item=where_item)
+                values, types = convert_row_values(where_item.values())
             elif isinstance(binlog_event, DeleteRowsEvent):
-                if replace:
-                    template = 'REPLACE INTO `{0}`.`{1}`({2}) VALUES ({3});'.format(
-                        db, tb,
-                        ', '.join(map(lambda key: '`%s`' % key, row['values'].keys())),
-                        ', '.join(['%s'] * len(row['values']))
-                    )
-                elif insert_ignore:
-                    template = 'INSERT IGNORE INTO `{0}`.`{1}`({2}) VALUES ({3});'.format(
-                        db, tb,
-                        ', '.join(map(lambda key: '`%s`' % key, row['values'].keys())),
-                        ', '.join(['%s'] * len(row['values']))
-                    )
-                else:
-                    template = 'INSERT INTO `{0}`.`{1}`({2}) VALUES ({3});'.format(
-                        db, tb,
-                        ', '.join(map(lambda key: '`%s`' % key, row['values'].keys())),
-                        ', '.join(['%s'] * len(row['values']))
-                    )
-                values = map(fix_object, row['values'].values())
-                types = map(fix_object_new, row['values'].values())
+                statement = 'REPLACE' if replace else 'INSERT IGNORE' if insert_ignore else 'INSERT'
+                template = get_sql_template(statement, db, tb, set_item=row['values'])
+                values, types = convert_row_values(row['values'].values())
             elif isinstance(binlog_event, UpdateRowsEvent):
                 if not update_to_replace:
-                    if not only_pk:
-                        template = 'UPDATE `{0}`.`{1}` SET {2} WHERE {3} LIMIT 1;'.format(
-                            db, tb,
-                            ', '.join(['`%s`=%%s' % x for x in row['before_values'].keys()]),
-                            ' AND '.join(map(compare_items, row['after_values'].items())))
-                        values = map(fix_object,
-                                     list(row['before_values'].values()) + list(row['after_values'].values()))
-                        types = map(
-                            fix_object_new, list(row['before_values'].values()) + list(row['after_values'].values())
-                        )
-                    else:
-                        pk_item = get_pk_item(binlog_event, row["after_values"])
-                        template = 'UPDATE `{0}`.`{1}` SET {2} WHERE {3} LIMIT 1;'.format(
-                            db, tb,
-                            ', '.join(['`%s`=%%s' % x for x in row['before_values'].keys()]),
-                            ' AND '.join(map(compare_items, pk_item.items())))
-                        values = map(fix_object, list(row['before_values'].values()) + list(pk_item.values()))
-                        types = map(fix_object_new, list(row['before_values'].values()) + list(pk_item.values()))
+                    where_item = row['after_values'] if not only_pk else \
+                        get_pk_item(binlog_event, row['after_values'])
+                    template = get_sql_template('UPDATE', db, tb, set_item=row['before_values'], where_item=where_item)
+                    values, types = convert_row_values(row['before_values'].values(), where_item.values())
                 else:
-                    template = 'REPLACE INTO `{0}`.`{1}` SET {2};'.format(
-                        db, tb,
-                        ', '.join(['`%s`=%%s' % x for x in row['before_values'].keys()]))
-                    values = map(fix_object, list(row['before_values'].values()))
-                    types = map(fix_object_new, list(row['before_values'].values()))
+                    template = get_sql_template('REPLACE SET', db, tb, set_item=row['before_values'])
+                    values, types = convert_row_values(row['before_values'].values())
         else:
             if isinstance(binlog_event, WriteRowsEvent):
                 if no_pk:
@@ -671,78 +797,65 @@ def generate_sql_pattern(binlog_event, row=None, flashback=False, no_pk=False, r
                         else:
                             row['values'].pop(binlog_event.primary_key)
 
-                if replace:
-                    template = 'REPLACE INTO `{0}`.`{1}`({2}) VALUES ({3});'.format(
-                        db, tb,
-                        ', '.join(map(lambda key: '`%s`' % key, row['values'].keys())),
-                        ', '.join(['%s'] * len(row['values']))
-                    )
-
-                elif insert_ignore:
-                    template = 'INSERT IGNORE INTO `{0}`.`{1}`({2}) VALUES ({3});'.format(
-                        db, tb,
-                        ', '.join(map(lambda key: '`%s`' % key, row['values'].keys())),
-                        ', '.join(['%s'] * len(row['values']))
-                    )
-                else:
-                    template = 'INSERT INTO `{0}`.`{1}`({2}) VALUES ({3});'.format(
-                        db, tb,
-                        ', '.join(map(lambda key: '`%s`' % key, row['values'].keys())),
-                        ', '.join(['%s'] * len(row['values']))
-                    )
-                values = map(fix_object, row['values'].values())
-                types = map(fix_object_new, row['values'].values())
+                statement = 'REPLACE' if replace else 'INSERT IGNORE' if insert_ignore else 'INSERT'
+                template = get_sql_template(statement, db, tb, set_item=row['values'])
+                values, types = convert_row_values(row['values'].values())
             elif isinstance(binlog_event, DeleteRowsEvent):
-                if not only_pk:
-                    template = 'DELETE FROM `{0}`.`{1}` WHERE {2} LIMIT 1;'.format(
-                        db, tb, ' AND '.join(map(compare_items, row['values'].items())))
-                    values = map(fix_object, row['values'].values())
-                    types = map(fix_object_new, row['values'].values())
-                else:
-                    pk_item = get_pk_item(binlog_event, row["values"])
-                    template = 'DELETE FROM `{0}`.`{1}` WHERE {2} LIMIT 1;'.format(
-                        db, tb, ' AND '.join(map(compare_items, pk_item.items())))
-                    values = map(fix_object, pk_item.values())
-                    types = map(fix_object_new, pk_item.values())
+                where_item = row['values'] if not only_pk else get_pk_item(binlog_event, row['values'])
+                template = get_sql_template('DELETE', db, tb, where_item=where_item)
+                values, types = convert_row_values(where_item.values())
             elif isinstance(binlog_event, UpdateRowsEvent):
                 if not update_to_replace:
-                    if not only_pk:
-                        template = 'UPDATE `{0}`.`{1}` SET {2} WHERE {3} LIMIT 1;'.format(
-                            db, tb,
-                            ', '.join(['`%s`=%%s' % k for k in row['after_values'].keys()]),
-                            ' AND '.join(map(compare_items, row['before_values'].items()))
-                        )
-                        values = map(fix_object,
-                                     list(row['after_values'].values()) + list(row['before_values'].values()))
-                        types = map(fix_object_new,
-                                    list(row['after_values'].values()) + list(row['before_values'].values()))
-                    else:
-                        pk_item = get_pk_item(binlog_event, row["before_values"])
-                        template = 'UPDATE `{0}`.`{1}` SET {2} WHERE {3} LIMIT 1;'.format(
-                            db, tb,
-                            ', '.join(['`%s`=%%s' % k for k in row['after_values'].keys()]),
-                            ' AND '.join(map(compare_items, pk_item.items()))
-                        )
-                        values = map(fix_object, list(row['after_values'].values()) + list(pk_item.values()))
-                        types = map(fix_object_new, list(row['after_values'].values()) + list(pk_item.values()))
+                    where_item = row['before_values'] if not only_pk else \
+                        get_pk_item(binlog_event, row['before_values'])
+                    template = get_sql_template('UPDATE', db, tb, set_item=row['after_values'], where_item=where_item)
+                    values, types = convert_row_values(row['after_values'].values(), where_item.values())
                 else:
-                    template = 'REPLACE INTO `{0}`.`{1}` SET {2};'.format(
-                        db, tb,
-                        ', '.join(['`%s`=%%s' % k for k in row['after_values'].keys()])
-                    )
-                    values = map(fix_object, list(row['after_values'].values()))
-                    types = map(fix_object_new, list(row['after_values'].values()))
+                    template = get_sql_template('REPLACE SET', db, tb, set_item=row['after_values'])
+                    values, types = convert_row_values(row['after_values'].values())
 
     result = (
-        {'template': template, 'values': list(values)},
+        {'template': template, 'values': values},
         db,
         table,
     )
     if return_type:
-        return result, list(types)
+        return result, types
     return result
 
 
+def compile_gtid_ranges(gtids: str) -> dict:
+    """
+    Parse gtids like uuid:1-10:20,uuid2:5 into {uuid: (starts, ends)}. Intervals of one uuid are sorted and merged
+    once, so that is_want_gtid looks up a transaction with bisect instead of parsing every range string each time.
+    """
+    uuid_ranges = {}
+    for gtid in gtids.split(','):
+        gtid = gtid.strip()
+        if not gtid:
+            continue
+        uuid, *txn_ranges = gtid.split(':')
+        ranges = uuid_ranges.setdefault(uuid.strip().lower(), [])
+        for txn_range in txn_ranges:
+            txn_split = txn_range.split('-')
+            txn_min = int(txn_split[0])
+            txn_max = int(txn_split[1]) if len(txn_split) > 1 else txn_min
+            ranges.append((txn_min, txn_max))
+
+    compiled = {}
+    for uuid, ranges in uuid_ranges.items():
+        starts, ends = [], []
+        for txn_min, txn_max in sorted(ranges):
+            # 重叠或相邻的区间合并
+            if ends and txn_min <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], txn_max)
+            else:
+                starts.append(txn_min)
+                ends.append(txn_max)
+        compiled[uuid] = (starts, ends)
+    return compiled
+
+
 def get_gtid_set(include_gtids, exclude_gtids):
     # gtid 示例
     # 35191261-90cd-11e9-9398-00163e0ef40e:2840-134906:134908-183611:183613-351746:360220-364062,
@@ -751,83 +864,125 @@ def get_gtid_set(include_gtids, exclude_gtids):
     # fcb79f76-b484-11eb-9d4c-00163e047dcb:7273871-7277930
     gtid_set = {}
     if include_gtids:
-        gtid_set['include'] = {}
-        gtids = include_gtids.split(',')
-        for gtid in gtids:
-            gtid_splited = gtid.split(':')
-            uuid = gtid_splited[0]
-            if uuid not in gtid_set:
-                gtid_set['include'][uuid] = []
-            txn_range = gtid_splited[1:]
-            gtid_set['include'][uuid].extend(txn_range)
-
+        gtid_set['include'] = compile_gtid_ranges(include_gtids)
     if exclude_gtids:
-        gtid_set['exclude'] = {}
-        gtids = exclude_gtids.split(',')
-        for gtid in gtids:
-            gtid_splited = gtid.split(':')
-            uuid = gtid_splited[0]
-            if uuid not in gtid_set:
-                gtid_set['exclude'][uuid] = []
-            txn_range = gtid_splited[1:]
-            gtid_set['exclude'][uuid].extend(txn_range)
-
+        gtid_set['exclude'] = compile_gtid_ranges(exclude_gtids)
     return gtid_set
 
 
+def gtid_in_ranges(gtid_ranges, uuid, txn):
+    if uuid not in gtid_ranges:
+        return False
+    starts, ends = gtid_ranges[uuid]
+    i = bisect_right(starts, txn) - 1
+    return i >= 0 and txn <= ends[i]
+
+
 def is_want_gtid(gtid_set, gtid):
-    gtid_split = gtid.split(':')
-    uuid = gtid_split[0]
-    txn = int(gtid_split[1])
-    if 'include' in gtid_set and uuid in gtid_set['include']:
-        txn_ranges = gtid_set['include'][uuid]
-        for txn_range in txn_ranges:
-            txn_split = txn_range.split('-')
-            txn_min = int(txn_split[0])
-            txn_max = int(txn_split[1]) if len(txn_split) > 1 else txn_min
-            if txn_min <= txn <= txn_max:
-                return True
-        else:
-            return False
-    elif 'exclude' in gtid_set and uuid in gtid_set['exclude']:
-        txn_ranges = gtid_set['exclude'][uuid]
-        for txn_range in txn_ranges:
-            txn_split = txn_range.split('-')
-            txn_min = int(txn_split[0])
-            txn_max = int(txn_split[1]) if len(txn_split) > 1 else txn_min
-            if txn_min <= txn <= txn_max:
-                return False
-        else:
-            return True
+    """
+    Whether transaction gtid passes --include-gtids and --exclude-gtids: it must be in the include set if given,
+    and must not be in the exclude set. O(log n) in the number of intervals of its uuid.
+    """
+    uuid, _, txn = gtid.rpartition(':')
+    txn = int(txn)
+    if 'include' in gtid_set and not gtid_in_ranges(gtid_set['include'], uuid, txn):
+        return False
+    if 'exclude' in gtid_set and gtid_in_ranges(gtid_set['exclude'], uuid, txn):
+        return False
+    return True
 
 
 def get_max_gtid(include_gtid_set):
-    gtid_max_dict = {}
-    for uuid, txn_ranges in include_gtid_set.items():
-        for txn_range in txn_ranges:
-            txn_split = txn_range.split('-')
-            txn_min = int(txn_split[0])
-            txn_max = int(txn_split[1]) if len(txn_split) > 1 else txn_min
-            if uuid in gtid_max_dict:
-                gtid_max = gtid_max_dict[uuid]
-                if txn_max > gtid_max:
-                    gtid_max_dict[uuid] = txn_max
-            else:
-                gtid_max_dict[uuid] = txn_max
-    return gtid_max_dict
+    # 只写 uuid、不带区间的项没有最大事务号，跳过
+    return {uuid: ends[-1] for uuid, (starts, ends) in include_gtid_set.items() if ends}
 
 
 def remove_max_gtid(gtid_max_dict, gtid):
-    gtid_split = gtid.split(':')
-    uuid = gtid_split[0]
-    txn = int(gtid_split[1])
-    if uuid in gtid_max_dict:
-        txn_max = gtid_max_dict[uuid]
-        if txn > txn_max:
-            del gtid_max_dict[uuid]
+    uuid, _, txn = gtid.rpartition(':')
+    if uuid in gtid_max_dict and int(txn) > gtid_max_dict[uuid]:
+        del gtid_max_dict[uuid]
     return
 
 
+def parse_server_id_range(server_id_range: str):
+    id_range = server_id_range.split('-')
+    id_min = int(id_range[0])
+    id_max = int(id_range[1]) if len(id_range) > 1 else id_min
+    if id_min <= 0 or id_max < id_min:
+        raise ValueError('Invalid server id range: %s' % server_id_range)
+    return id_min, id_max
+
+
+def allocate_server_id(server_id_range: str, seed: str = '') -> int:
+    """Pick a replica server id from a range like 1000-1999 by hostname, pid and seed"""
+    id_min, id_max = parse_server_id_range(server_id_range)
+    key = '%s:%s:%s' % (socket.gethostname(), os.getpid(), seed)
+    return id_min + zlib.crc32(key.encode('utf8')) % (id_max - id_min + 1)
+
+
+def rotate_marker(log_file, position, output_format='sql'):
+    """Line printed in --stream mode when binlog rotates to log_file"""
+    if output_format == 'json':
+        return json.dumps({'type': 'ROTATE', 'binlog_file': log_file, 'end': position})
+    return '# rotate %s %s' % (log_file, position)
+
+
+def commit_marker(log_file, position, gtid, executed_gtid_set, output_format='sql'):
+    """Line printed in --stream mode after transaction gtid, when the executed GTID set is tracked"""
+    if output_format == 'json':
+        return json.dumps({'type': 'COMMIT', 'binlog_file': log_file, 'end': position, 'gtid': gtid,
+                           'executed_gtid_set': str(executed_gtid_set)})
+    return '# commit %s %s %s' % (log_file, position, executed_gtid_set)
+
+
+def add_executed_gtid(executed_gtid_set: GtidSet, gtid: str) -> GtidSet:
+    gtid = Gtid(gtid)
+    # 重复读到已执行的事务时 Gtid 合并会因区间重叠报错
+    if gtid in executed_gtid_set:
+        return executed_gtid_set
+    return executed_gtid_set + gtid
+
+
+def previous_gtids_to_set(binlog_event) -> GtidSet:
+    """
+    PreviousGtidsEvent 中的区间是左闭右开的 [start, end)，pymysqlreplication 直接拼成了 start-end，
+    这里转换为闭区间后再解析
+    """
+    gtids = []
+    for gtid in filter(None, binlog_event._previous_gtids.split(',')):
+        sid, *intervals = gtid.split(':')
+        closed = []
+        for interval in intervals:
+            start, end = interval.split('-')
+            if int(end) - 1 >= int(start):
+                closed.append('%s-%s' % (start, int(end) - 1))
+        if closed:
+            gtids.append(':'.join([sid] + closed))
+    return GtidSet(','.join(gtids))
+
+
+def read_executed_gtid_set(conn_setting, server_id, log_file, log_pos) -> GtidSet:
+    """
+    GTID set executed before log_file:log_pos, that is the PreviousGtidsEvent at the head of log_file plus the
+    GtidEvents before log_pos. Only GTID events are decoded.
+    """
+    stream = BinLogStreamReader(connection_settings=dict(conn_setting), server_id=server_id, log_file=log_file,
+                                log_pos=4, resume_stream=True, blocking=False,
+                                only_events=[PreviousGtidsEvent, GtidEvent])
+    executed_gtid_set = GtidSet(None)
+    try:
+        for binlog_event in stream:
+            if stream.log_file != log_file or binlog_event.packet.log_pos > log_pos:
+                break
+            if isinstance(binlog_event, PreviousGtidsEvent):
+                executed_gtid_set = previous_gtids_to_set(binlog_event)
+            else:
+                executed_gtid_set = add_executed_gtid(executed_gtid_set, binlog_event.gtid)
+    finally:
+        stream.close()
+    return executed_gtid_set
+
+
 def save_result_sql(result_file, msg, mode='a', encoding='utf8'):
     with open(result_file, mode=mode, encoding=encoding) as f:
         f.write(msg)
@@ -917,5 +1072,212 @@ def connect2sync_mysql(args):
         max_allowed_packet=256 * 1024 * 1024,
         cursorclass=pymysql.cursors.DictCursor,
         autocommit=True,
+        # SyncApplier 将一个事务内的多条语句拼成一次请求发送
+        client_flag=CLIENT.MULTI_STATEMENTS,
     )
     return connection
+
+
+class SyncApplier(object):
+    """
+    Apply statements of one source transaction in one target transaction: statements are buffered until
+    commit() (called on XidEvent / COMMIT) and sent as multi-statement requests of at most max_batch_size bytes,
+    so a transaction costs a few round trips and one commit instead of one round trip and one commit per row.
+    The connection is only pinged after being idle for idle_ping_interval seconds.
+    """
+
+    def __init__(self, connection, max_batch_size=16 * 1024 * 1024, idle_ping_interval=60):
+        self.connection = connection
+        self.cursor = connection.cursor()
+        self.max_batch_size = max_batch_size
+        self.idle_ping_interval = idle_ping_interval
+        self.statements = []
+        self.size = 0
+        self.in_transaction = False
+        self.last_apply_time = time.time()
+
+    def add(self, sql):
+        self.statements.append(sql)
+        self.size += len(sql)
+        # 大事务分批发送，仍在同一个目标事务内
+        if self.size >= self.max_batch_size:
+            try:
+                self.__send()
+            except Exception:
+                self.rollback()
+                raise
+
+    def commit(self):
+        try:
+            self.__send()
+            if self.in_transaction:
+                self.connection.commit()
+        except Exception:
+            self.rollback()
+            raise
+        self.in_transaction = False
+        self.last_apply_time = time.time()
+
+    def rollback(self):
+        self.statements = []
+        self.size = 0
+        if self.in_transaction:
+            self.in_transaction = False
+            try:
+                self.connection.rollback()
+            except Exception:
+                logger.exception('Could not rollback sync transaction')
+
+    def execute(self, sql):
+        """Execute sql (e.g. DDL) alone after committing buffered statements"""
+        self.commit()
+        self.__ping_if_idle()
+        self.__execute(sql)
+        self.last_apply_time = time.time()
+
+    def __send(self):
+        if not self.statements:
+            return
+        if not self.in_transaction:
+            self.__ping_if_idle()
+            self.connection.begin()
+            self.in_transaction = True
+        sql = '\n'.join(self.statements)
+        self.statements = []
+        self.size = 0
+        self.__execute(sql)
+
+    def __execute(self, sql):
+        self.cursor.execute(sql)
+        # 多语句请求需要读完所有结果集，后续语句的错误也在这里抛出
+        while self.cursor.nextset():
+            pass
+
+    def __ping_if_idle(self):
+        if time.time() - self.last_apply_time >= self.idle_ping_interval:
+            self.connection.ping(reconnect=True)
+
+    def close(self):
+        self.rollback()
+        self.cursor.close()
+
+
+def get_row_keys(binlog_event):
+    """
+    (schema, table, primary key values) of every row the rows event touches, both before and after values of
+    updates. (schema, table) if the table has no primary key.
+    """
+    primary_keys = binlog_event.primary_key
+    if not primary_keys:
+        return {(binlog_event.schema, binlog_event.table)}
+    if not isinstance(primary_keys, tuple):
+        primary_keys = (primary_keys, )
+
+    keys = set()
+    for row in binlog_event.rows:
+        for values in (row.get('values'), row.get('before_values'), row.get('after_values')):
+            if values is not None:
+                keys.add((binlog_event.schema, binlog_event.table) + tuple(values.get(k) for k in primary_keys))
+    return keys
+
+
+class ParallelSyncApplier(object):
+    """
+    Apply transactions on several connections at once, each connection in its own thread with a SyncApplier.
+    A transaction whose rows (see get_row_keys) all hash to one worker is queued to that worker, so rows with the
+    same table and primary key are applied in source order. DDL and transactions spanning several workers wait
+    until all workers are idle and are then applied alone.
+    """
+
+    def __init__(self, connect, workers, **kwargs):
+        self.statements = []
+        self.keys = set()
+        self.error = None
+        self.queues = []
+        self.threads = []
+        self.connections = []
+        for i in range(workers):
+            connection = connect()
+            task_queue = queue.Queue()
+            thread = threading.Thread(target=self.__apply_loop, args=(SyncApplier(connection, **kwargs), task_queue),
+                                      name=f'sync-worker-{i}', daemon=True)
+            thread.start()
+            self.connections.append(connection)
+            self.queues.append(task_queue)
+            self.threads.append(thread)
+
+    def add(self, sql):
+        self.statements.append(sql)
+
+    def add_keys(self, keys):
+        self.keys.update(keys)
+
+    def commit(self):
+        self.__check_error()
+        statements, keys = self.statements, self.keys
+        self.statements, self.keys = [], set()
+        if not statements:
+            return
+
+        workers = {hash(key) % len(self.queues) for key in keys}
+        if len(workers) == 1:
+            self.queues[workers.pop()].put((statements, False))
+        else:
+            self.barrier()
+            self.__apply_alone(statements, False)
+
+    def rollback(self):
+        self.statements, self.keys = [], set()
+
+    def execute(self, sql):
+        """Execute sql (e.g. DDL) alone after all queued transactions are applied"""
+        self.commit()
+        self.barrier()
+        self.__apply_alone([sql], True)
+
+    def barrier(self):
+        for task_queue in self.queues:
+            task_queue.join()
+        self.__check_error()
+
+    def close(self):
+        self.rollback()
+        for task_queue in self.queues:
+            task_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        for connection in self.connections:
+            connection.close()
+
+    def __apply_alone(self, statements, is_ddl):
+        self.queues[0].put((statements, is_ddl))
+        self.queues[0].join()
+        self.__check_error()
+
+    def __check_error(self):
+        if self.error is not None:
+            raise RuntimeError(f'Sync worker failed: {self.error}')
+
+    def __apply_loop(self, applier, task_queue):
+        while True:
+            task = task_queue.get()
+            statements = []
+            try:
+                if task is None:
+                    applier.close()
+                    return
+                # 任一线程出错后不再应用后续事务，等待主线程退出
+                if self.error is not None:
+                    continue
+                statements, is_ddl = task
+                if is_ddl:
+                    applier.execute(statements[0])
+                else:
+                    for sql in statements:
+                        applier.add(sql)
+                    applier.commit()
+            except Exception as e:
+                logger.exception('Could not execute sql: %s' % (statements[0] if statements else ''))
+                self.error = e
+            finally:
+                task_queue.task_done()
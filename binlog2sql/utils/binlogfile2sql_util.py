@@ -1,14 +1,23 @@
 # -*- coding: utf-8 -*-
 import os
+import re
+import mmap
+import json
+import bisect
+import hashlib
 import pymysql
 import struct
 import argparse
 import getpass
 import sys
 from pymysql.cursors import DictCursor
-from utils.binlog2sql_util import is_valid_datetime, logger, sep, extend_parser
+from utils.binlog2sql_util import is_valid_datetime, logger, sep, extend_parser, is_want_gtid
 from pymysqlreplication.packet import BinLogPacketWrapper
-from pymysqlreplication.constants.BINLOG import TABLE_MAP_EVENT, ROTATE_EVENT
+from pymysqlreplication.constants import FIELD_TYPE
+from pymysqlreplication.constants.BINLOG import TABLE_MAP_EVENT, ROTATE_EVENT, QUERY_EVENT, XID_EVENT, \
+    GTID_LOG_EVENT, ANONYMOUS_GTID_LOG_EVENT, MARIADB_GTID_EVENT, WRITE_ROWS_EVENT_V1, UPDATE_ROWS_EVENT_V1, \
+    DELETE_ROWS_EVENT_V1, WRITE_ROWS_EVENT_V2, UPDATE_ROWS_EVENT_V2, DELETE_ROWS_EVENT_V2, STOP_EVENT, \
+    FORMAT_DESCRIPTION_EVENT, BEGIN_LOAD_QUERY_EVENT, EXECUTE_LOAD_QUERY_EVENT, HEARTBEAT_LOG_EVENT
 from pymysqlreplication.event import (
     QueryEvent, RotateEvent, FormatDescriptionEvent,
     XidEvent, GtidEvent, StopEvent,
@@ -25,18 +34,60 @@ except ImportError:
     COM_BINLOG_DUMP_GTID = 0x1e
 
 from io import BytesIO
-from pymysql.util import byte2int
 
 # 2013 Connection Lost
 # 2006 MySQL server has gone away
 MYSQL_EXPECTED_ERROR_CODES = [2013, 2006]
 
 
+ROWS_EVENTS = frozenset([WRITE_ROWS_EVENT_V1, UPDATE_ROWS_EVENT_V1, DELETE_ROWS_EVENT_V1,
+                         WRITE_ROWS_EVENT_V2, UPDATE_ROWS_EVENT_V2, DELETE_ROWS_EVENT_V2])
+
+# 按事件头跳过事件时使用的事件类型，与 BinLogPacketWrapper 的映射一致，只列出 binlog2sql 用到的事件
+EVENT_CLASSES = {
+    QUERY_EVENT: QueryEvent,
+    ROTATE_EVENT: RotateEvent,
+    STOP_EVENT: StopEvent,
+    FORMAT_DESCRIPTION_EVENT: FormatDescriptionEvent,
+    XID_EVENT: XidEvent,
+    GTID_LOG_EVENT: GtidEvent,
+    ANONYMOUS_GTID_LOG_EVENT: NotImplementedEvent,
+    BEGIN_LOAD_QUERY_EVENT: BeginLoadQueryEvent,
+    EXECUTE_LOAD_QUERY_EVENT: ExecuteLoadQueryEvent,
+    HEARTBEAT_LOG_EVENT: HeartbeatLogEvent,
+    TABLE_MAP_EVENT: TableMapEvent,
+    WRITE_ROWS_EVENT_V1: WriteRowsEvent,
+    UPDATE_ROWS_EVENT_V1: UpdateRowsEvent,
+    DELETE_ROWS_EVENT_V1: DeleteRowsEvent,
+    WRITE_ROWS_EVENT_V2: WriteRowsEvent,
+    UPDATE_ROWS_EVENT_V2: UpdateRowsEvent,
+    DELETE_ROWS_EVENT_V2: DeleteRowsEvent,
+}
+
+
 class StringIOAdvance(BytesIO):
     def advance(self, length):
         self.seek(self.tell() + length)
 
 
+class MemoryViewAdvance(object):
+    """Packet over the mapped binlog file, read() only copies the bytes asked by the parser"""
+    __slots__ = ('_view', '_pos', '_end')
+
+    def __init__(self, view, start, end):
+        self._view = view
+        self._pos = start
+        self._end = end
+
+    def read(self, size):
+        pos = self._pos
+        self._pos = min(pos + size, self._end)
+        return self._view[pos:self._pos].tobytes()
+
+    def advance(self, length):
+        self._pos = min(self._pos + length, self._end)
+
+
 class BinLogFileReader(object):
     """Connect to replication stream and read event
     """
@@ -47,12 +98,18 @@ class BinLogFileReader(object):
                  log_file=None, log_pos=None, filter_non_implemented_events=True, stop_pos=None, ignored_events=None,
                  auto_position=None, only_tables=None, ignored_tables=None, only_schemas=None, ignored_schemas=None,
                  freeze_schema=False, skip_to_timestamp=None, slave_uuid=None, pymysql_wrapper=None,
-                 fail_on_table_metadata_unavailable=False, slave_heartbeat=None, ignore_virtual_columns=False):
+                 fail_on_table_metadata_unavailable=False, slave_heartbeat=None, ignore_virtual_columns=False,
+                 seek_pos=None, schema_cache=None):
 
         # open file
         self._file = None
         self._file_path = file_path
         self._pos = None
+        self._mmap = None
+        self._view = None
+        self._use_mmap = False
+        # 读完 FormatDescriptionEvent 后直接跳到该位置（事务起始事件），由 binlog index 给出
+        self._seek_pos = seek_pos
 
         self.__connected_stream = False
         self.__connected_ctl = False
@@ -79,6 +136,11 @@ class BinLogFileReader(object):
 
         # Store table meta information
         self.table_map = {}
+        # table id of TableMapEvent filtered by only/ignored tables and schemas, their rows events are skipped
+        self.__skipped_table_ids = set()
+        # 不在 EVENT_CLASSES 中的事件，只有允许的事件都在其中时才能按事件头直接跳过，否则交给 BinLogPacketWrapper 判断
+        self.__skip_unknown_events = NotImplementedEvent not in self.__allowed_events_in_packet and \
+            self.__allowed_events_in_packet.issubset(EVENT_CLASSES.values())
         self.log_pos = log_pos
         self.start_pos = log_pos
         self.stop_pos = stop_pos
@@ -90,6 +152,8 @@ class BinLogFileReader(object):
         self.slave_uuid = slave_uuid
         self.slave_heartbeat = slave_heartbeat
         self.ignore_virtual_columns = ignore_virtual_columns
+        self.mysql_version = (0, 0, 0)
+        self.schema_cache = schema_cache
 
         if pymysql_wrapper:
             self.pymysql_wrapper = pymysql_wrapper
@@ -100,6 +164,7 @@ class BinLogFileReader(object):
         self.__use_checksum = self.__checksum_enabled()
 
     def close(self):
+        self.__release_map()
         if self._file:
             self._file.close()
             self._file_path = None
@@ -109,6 +174,12 @@ class BinLogFileReader(object):
             self.__connected_ctl = False
 
     def __connect_to_ctl(self):
+        if self.schema_cache is not None and self.schema_cache.offline:
+            # 离线模式下表结构和 binlog_checksum 都来自 schema snapshot，不连接数据库
+            self._ctl_connection = OfflineCtlConnection(self._ctl_connection_settings.get('charset', 'utf8mb4'))
+            self._ctl_connection._get_table_information = self.__get_table_information
+            self.__connected_ctl = True
+            return
         self._ctl_connection_settings["db"] = "information_schema"
         self._ctl_connection_settings["cursorclass"] = DictCursor
         self._ctl_connection = self.pymysql_wrapper(**self._ctl_connection_settings)
@@ -117,6 +188,8 @@ class BinLogFileReader(object):
 
     def __checksum_enabled(self):
         """Return True if binlog-checksum = CRC32. Only for MySQL > 5.6"""
+        if self.schema_cache is not None and self.schema_cache.offline:
+            return self.schema_cache.binlog_checksum not in (None, 'NONE')
         try:
             if not self.__connected_ctl and self._ctl_connection_settings:
                 self.__connect_to_ctl()
@@ -134,14 +207,48 @@ class BinLogFileReader(object):
         except Exception:
             return False
 
+    def __map_file(self):
+        """Map the whole binlog file read only, return False if it could not be mapped (empty file, pipe ...)"""
+        self.__release_map()
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            self._mmap = None
+            return False
+        self._view = memoryview(self._mmap)
+        return True
+
+    def __release_map(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # 仍有事件引用旧的映射，交给 GC 回收
+                pass
+            self._mmap = None
+
+    def __map_covers(self, end):
+        """Make sure the mapping covers [0, end), remap if the file has grown since it was mapped"""
+        if end <= len(self._view):
+            return True
+        if os.fstat(self._file.fileno()).st_size < end:
+            return False
+        return self.__map_file() and end <= len(self._view)
+
     def __connect_to_stream(self):
         if self._file is None:
-            self._file = open(self._file_path, 'rb+')
-            self._pos = self._file.tell()
-            assert self._pos == 0
+            self._file = open(self._file_path, 'rb')
+            self._pos = 0
+            self._use_mmap = self.__map_file()
         # read magic
         if self._pos == 0:
-            magic = self._file.read(4)
+            if self._use_mmap:
+                magic = self._view[:4].tobytes()
+            else:
+                magic = self._file.read(4)
             if magic == self._expected_magic:
                 self._pos += len(magic)
             else:
@@ -149,6 +256,103 @@ class BinLogFileReader(object):
                 message = messagefmt.format(magic, self._expected_magic)
                 raise BadMagicBytesError(message)
 
+    def __next_packet(self):
+        """Return packet of the next wanted event, None if there is no complete event left"""
+        while True:
+            if self._seek_pos and self._pos > 4:
+                if self._seek_pos > self._pos:
+                    self._pos = self._seek_pos
+                    if not self._use_mmap:
+                        self._file.seek(self._pos)
+                self._seek_pos = None
+            if self._use_mmap:
+                if not self.__map_covers(self._pos + 19):
+                    return None
+                event_type, event_size, log_pos = struct.unpack_from('<4xB4xII', self._view, self._pos)
+                if event_size < 19:
+                    raise EventSizeTooSmallError('Event size %s at pos %s' % (event_size, self._pos))
+                if not self.__map_covers(self._pos + event_size):
+                    return None
+                skip = self.__skip_event(event_type, self._view[self._pos + 19:self._pos + event_size])
+                # 从 header 前一个字节开始切片，充当 BinLogPacketWrapper 跳过的 OK 字节，不再拷贝拼接 b'0' + header + body
+                pkt = None if skip else MemoryViewAdvance(self._view, self._pos - 1, self._pos + event_size)
+            else:
+                # 文件仍在写入时最后一个事件可能不完整，回到事件起始位置，下次从这里重新读取
+                header = self._file.read(19)
+                if len(header) < 19:
+                    self._file.seek(self._pos)
+                    return None
+                event_type, event_size, log_pos = struct.unpack_from('<4xB4xII', header)
+                if event_size < 19:
+                    raise EventSizeTooSmallError('Event size %s at pos %s' % (event_size, self._pos))
+                # rows event 只需读出 table id 就能判断是否跳过
+                body_size = 6 if event_type in ROWS_EVENTS else event_size - 19
+                body = self._file.read(body_size)
+                if len(body) < body_size:
+                    self._file.seek(self._pos)
+                    return None
+                skip = self.__skip_event(event_type, body)
+                if skip:
+                    self._file.seek(self._pos + event_size)
+                    pkt = None
+                else:
+                    if len(body) < event_size - 19:
+                        body += self._file.read(event_size - 19 - len(body))
+                        if len(body) < event_size - 19:
+                            self._file.seek(self._pos)
+                            return None
+                    pkt = StringIOAdvance(b'0' + header + body)
+            self._pos += event_size
+            if pkt is not None:
+                return pkt
+            if self.stop_pos and log_pos >= self.stop_pos:
+                return None
+
+    def __skip_event(self, event_type, body):
+        """
+        Decide by event header, and the table id / table name at the head of body, if the event would be filtered
+        anyway, so we could step over it without building BinLogPacketWrapper.
+        """
+        event_class = EVENT_CLASSES.get(event_type)
+        if event_class is None:
+            return self.__skip_unknown_events
+        if event_class not in self.__allowed_events_in_packet:
+            return True
+        if event_type in ROWS_EVENTS:
+            table_id = struct.unpack('<Q', bytes(body[:6]) + b'\x00\x00')[0]
+            # 没有对应 TableMapEvent 的 rows event 在 RowsEvent 中同样会被丢弃
+            return table_id in self.__skipped_table_ids or table_id not in self.table_map
+        if event_type == TABLE_MAP_EVENT:
+            table_id = struct.unpack('<Q', bytes(body[:6]) + b'\x00\x00')[0]
+            try:
+                schema_length = body[8]
+                schema = bytes(body[9:9 + schema_length]).decode()
+                table_length = body[10 + schema_length]
+                table = bytes(body[11 + schema_length:11 + schema_length + table_length]).decode()
+            except (IndexError, UnicodeDecodeError):
+                return False
+            if self.__table_filtered(schema, table):
+                self.__skipped_table_ids.add(table_id)
+                return True
+            self.__skipped_table_ids.discard(table_id)
+            # table_map 中已有的 table id 沿用之前的列信息，不会再查询表结构
+            if self.schema_cache is not None and table_id not in self.table_map:
+                column_types = table_map_column_types(body, 12 + schema_length + table_length)
+                self.schema_cache.validate(schema, table, column_types)
+        return False
+
+    def __table_filtered(self, schema, table):
+        """Same filter as TableMapEvent"""
+        if self.__only_tables is not None and table not in self.__only_tables:
+            return True
+        elif self.__ignored_tables is not None and table in self.__ignored_tables:
+            return True
+        if self.__only_schemas is not None and schema not in self.__only_schemas:
+            return True
+        elif self.__ignored_schemas is not None and schema in self.__ignored_schemas:
+            return True
+        return False
+
     def fetchone(self):
         while True:
             if not self._file:
@@ -158,28 +362,13 @@ class BinLogFileReader(object):
                 self.__connect_to_ctl()
 
             # read pkt
-            pkt = StringIOAdvance()
-            # headerlength 19
-            header = self._file.read(19)
-            if not header:
+            pkt = self.__next_packet()
+            if pkt is None:
                 break
 
-            unpacked = struct.unpack('<IcIIIH', header)
-            timestamp = unpacked[0]
-            event_type = byte2int(unpacked[1])
-            server_id = unpacked[2]
-            event_size = unpacked[3]
-            log_pos = unpacked[4]
-            flags = unpacked[5]
-
-            body = self._file.read(event_size - 19)
-            pkt.write(b'0')
-            pkt.write(header)
-            pkt.write(body)
-            pkt.seek(0)
-
             binlog_event = BinLogPacketWrapper(pkt, self.table_map,
                                                self._ctl_connection,
+                                               self.mysql_version,
                                                self.__use_checksum,
                                                self.__allowed_events_in_packet,
                                                self.__only_tables,
@@ -187,7 +376,9 @@ class BinLogFileReader(object):
                                                self.__only_schemas,
                                                self.__ignored_schemas,
                                                self.__freeze_schema,
-                                               self.__fail_on_table_metadata_unavailable)
+                                               self.__fail_on_table_metadata_unavailable,
+                                               False,
+                                               False)
 
             if not binlog_event.event or binlog_event.log_pos < self.start_pos:
                 continue
@@ -208,6 +399,7 @@ class BinLogFileReader(object):
                 # again for each logfile which is potentially wasted effort but we can't really do much better
                 # without being broken in restart case
                 self.table_map = {}
+                self.__skipped_table_ids = set()
             elif binlog_event.log_pos:
                 self.log_pos = binlog_event.log_pos
 
@@ -243,11 +435,18 @@ class BinLogFileReader(object):
                 self.table_map[binlog_event.event.table_id] = \
                     binlog_event.event.get_table()
 
+            if self.schema_cache is not None and binlog_event.event_type == QUERY_EVENT and \
+                    binlog_event.event is not None:
+                self.schema_cache.invalidate_by_query(binlog_event.event.schema, binlog_event.event.query)
+
             # event is none if we have filter it on packet level
             # we filter also not allowed events
             if binlog_event.event is None or (binlog_event.event.__class__ not in self.__allowed_events):
                 continue
 
+            if isinstance(binlog_event.event, FormatDescriptionEvent):
+                self.mysql_version = binlog_event.event.mysql_version
+
             return binlog_event.event
 
     def _allowed_event_list(self, only_events, ignored_events,
@@ -282,6 +481,10 @@ class BinLogFileReader(object):
         return frozenset(events)
 
     def __get_table_information(self, schema, table):
+        if self.schema_cache is not None:
+            columns = self.schema_cache.get(schema, table)
+            if columns is not None:
+                return columns
         for i in range(1, 3):
             try:
                 if not self.__connected_ctl:
@@ -292,7 +495,8 @@ class BinLogFileReader(object):
                     sql = """
                         SELECT
                             COLUMN_NAME, COLLATION_NAME, CHARACTER_SET_NAME,
-                            COLUMN_COMMENT, COLUMN_TYPE, COLUMN_KEY, ORDINAL_POSITION
+                            COLUMN_COMMENT, COLUMN_TYPE, COLUMN_KEY, ORDINAL_POSITION,
+                            DATA_TYPE, CHARACTER_OCTET_LENGTH
                         FROM
                             information_schema.columns
                         WHERE
@@ -305,7 +509,8 @@ class BinLogFileReader(object):
                     sql = """
                         SELECT
                             COLUMN_NAME, COLLATION_NAME, CHARACTER_SET_NAME,
-                            COLUMN_COMMENT, COLUMN_TYPE, COLUMN_KEY, ORDINAL_POSITION
+                            COLUMN_COMMENT, COLUMN_TYPE, COLUMN_KEY, ORDINAL_POSITION,
+                            DATA_TYPE, CHARACTER_OCTET_LENGTH
                         FROM
                             information_schema.columns
                         WHERE
@@ -315,7 +520,10 @@ class BinLogFileReader(object):
                     """ % (schema, table)
 
                 cur.execute(sql)
-                return cur.fetchall()
+                columns = cur.fetchall()
+                if self.schema_cache is not None:
+                    self.schema_cache.put(schema, table, columns)
+                return columns
             except pymysql.OperationalError as error:
                 code, message = error.args
                 if code in MYSQL_EXPECTED_ERROR_CODES:
@@ -338,6 +546,425 @@ class EventSizeTooSmallError(Exception):
     pass
 
 
+# TableMapEvent 中的列类型与 information_schema.columns 中 DATA_TYPE 的对应关系，用于校验缓存的列信息
+FIELD_TYPE_DATA_TYPES = {
+    FIELD_TYPE.DECIMAL: {'decimal'},
+    FIELD_TYPE.NEWDECIMAL: {'decimal'},
+    FIELD_TYPE.TINY: {'tinyint'},
+    FIELD_TYPE.SHORT: {'smallint'},
+    FIELD_TYPE.INT24: {'mediumint'},
+    FIELD_TYPE.LONG: {'int'},
+    FIELD_TYPE.LONGLONG: {'bigint'},
+    FIELD_TYPE.FLOAT: {'float'},
+    FIELD_TYPE.DOUBLE: {'double'},
+    FIELD_TYPE.BIT: {'bit'},
+    FIELD_TYPE.YEAR: {'year'},
+    FIELD_TYPE.DATE: {'date'},
+    FIELD_TYPE.NEWDATE: {'date'},
+    FIELD_TYPE.TIME: {'time'},
+    FIELD_TYPE.TIME2: {'time'},
+    FIELD_TYPE.DATETIME: {'datetime'},
+    FIELD_TYPE.DATETIME2: {'datetime'},
+    FIELD_TYPE.TIMESTAMP: {'timestamp'},
+    FIELD_TYPE.TIMESTAMP2: {'timestamp'},
+    FIELD_TYPE.JSON: {'json'},
+    FIELD_TYPE.VARCHAR: {'varchar', 'varbinary'},
+    FIELD_TYPE.VAR_STRING: {'varchar', 'varbinary'},
+    # enum、set 在 TableMapEvent 中的类型为 STRING，真实类型在元数据中
+    FIELD_TYPE.STRING: {'char', 'binary', 'enum', 'set'},
+    FIELD_TYPE.ENUM: {'enum'},
+    FIELD_TYPE.SET: {'set'},
+    FIELD_TYPE.BLOB: {'tinyblob', 'blob', 'mediumblob', 'longblob', 'tinytext', 'text', 'mediumtext', 'longtext'},
+    FIELD_TYPE.GEOMETRY: {'geometry', 'point', 'linestring', 'polygon', 'multipoint', 'multilinestring',
+                          'multipolygon', 'geometrycollection', 'geomcollection'},
+}
+
+
+def table_map_column_types(body, offset):
+    """Column types of TableMapEvent body, offset is where the column count starts. None if body is broken"""
+    try:
+        first = body[offset]
+        if first < 251:
+            count, offset = first, offset + 1
+        else:
+            size = {252: 2, 253: 3, 254: 8}[first]
+            count = int.from_bytes(bytes(body[offset + 1:offset + 1 + size]), 'little')
+            offset += 1 + size
+        column_types = bytes(body[offset:offset + count])
+    except (IndexError, KeyError):
+        return None
+    return column_types if len(column_types) == count else None
+
+
+# DDL 中影响表结构的语句，用于失效 SchemaCache
+DDL_RE = re.compile(r'(ALTER|CREATE|DROP|RENAME)\s+(?:(?:TEMPORARY|ONLINE|OFFLINE|IGNORE|UNIQUE|FULLTEXT|SPATIAL)\s+)*'
+                    r'(TABLES?|INDEX|DATABASE|SCHEMA)\b(.*)', re.I | re.S)
+DDL_NAME_RE = re.compile(r'\s*(`[^`]+`|[\w$]+)(?:\s*\.\s*(`[^`]+`|[\w$]+))?')
+
+
+class SchemaCache(object):
+    """
+    Column information of tables from information_schema.columns, keyed by (schema, table).
+    It is shared by all binlog files of a run, invalidated by DDL QueryEvent, and saved into snapshot_file
+    (if given) so the next run could use it too.
+    With offline=True, snapshot_file is a schema snapshot from export_schema_snapshot, and it is the only source of
+    table columns and binlog_checksum, the cache is read only then.
+    With persist=False snapshot_file is only loaded, it is used by --workers processes which would overwrite
+    each other's file.
+    """
+
+    def __init__(self, snapshot_file=None, source='', ignore_virtual_columns=False, offline=False, persist=True):
+        self.snapshot_file = snapshot_file
+        self.source = source
+        self.ignore_virtual_columns = ignore_virtual_columns
+        self.offline = offline
+        self.persist = persist
+        self.binlog_checksum = None
+        self._tables = {}
+        self._dirty = False
+        self._missing = set()
+        if offline and not (snapshot_file and os.path.exists(snapshot_file)):
+            raise ValueError(f'Schema snapshot file not found: {snapshot_file}')
+        if snapshot_file and os.path.exists(snapshot_file):
+            self.load()
+
+    def get(self, schema, table):
+        columns = self._tables.get((schema, table))
+        if columns is None and self.offline:
+            if (schema, table) not in self._missing:
+                self._missing.add((schema, table))
+                logger.warning(f'Table {schema}.{table} is not in schema snapshot {self.snapshot_file}, '
+                               f'its columns will be named like __dropped_col_N__')
+            return []
+        return columns
+
+    def validate(self, schema, table, column_types):
+        """
+        Check cached columns of table against the column types of its TableMapEvent. The cache may be stale when the
+        DDL is not parsed in this run (skipped by the binlog index, or in files out of the range), then the entry is
+        dropped so that columns are read from the server again. A snapshot in offline mode could only be warned.
+        """
+        columns = self._tables.get((schema, table))
+        if columns is None or column_types is None or self.columns_match(columns, column_types):
+            return True
+        if self.offline:
+            if (schema, table) not in self._missing:
+                self._missing.add((schema, table))
+                logger.warning(f'Columns of {schema}.{table} in schema snapshot {self.snapshot_file} do not match '
+                               f'the binlog, rows may be decoded with wrong columns')
+            return False
+        logger.warning(f'Cached columns of {schema}.{table} do not match the binlog, read them from the server again')
+        self.invalidate(schema, table)
+        return False
+
+    def columns_match(self, columns, column_types):
+        # 忽略虚拟列时缓存中缺少部分列，按 ORDINAL_POSITION 对应
+        if not self.ignore_virtual_columns and len(columns) != len(column_types):
+            return False
+        for column in columns:
+            i = column['ORDINAL_POSITION'] - 1
+            if i >= len(column_types):
+                return False
+            data_types = FIELD_TYPE_DATA_TYPES.get(column_types[i])
+            if data_types is not None and str(column['DATA_TYPE']).lower() not in data_types:
+                return False
+        return True
+
+    def put(self, schema, table, columns):
+        self._tables[(schema, table)] = list(columns)
+        self._dirty = True
+
+    def invalidate(self, schema, table=None):
+        if table is not None:
+            if self._tables.pop((schema, table), None) is not None:
+                self._dirty = True
+            return
+        for key in [k for k in self._tables if k[0] == schema]:
+            del self._tables[key]
+            self._dirty = True
+
+    def clear(self):
+        if self._tables:
+            self._tables = {}
+            self._dirty = True
+
+    def invalidate_by_query(self, schema, query):
+        """Drop cached tables changed by DDL query, clear all if we could not tell which tables are changed"""
+        if self.offline:
+            return
+        if isinstance(schema, bytes):
+            schema = schema.decode('utf8', errors='replace')
+        query = re.sub(r'/\*.*?\*/', ' ', query, flags=re.S).strip()
+        m = DDL_RE.match(query)
+        if m is None:
+            return
+        action, kind, rest = m.group(1).upper(), m.group(2).upper(), m.group(3)
+        rest = re.sub(r'^\s*IF\s+(NOT\s+)?EXISTS\b', '', rest, flags=re.I)
+        if kind in ('DATABASE', 'SCHEMA'):
+            m = DDL_NAME_RE.match(rest)
+            if m is None:
+                self.clear()
+            else:
+                self.invalidate(m.group(1).strip('`'))
+            return
+
+        if kind == 'INDEX':
+            on = re.search(r'\bON\b(.*)', rest, re.I | re.S)
+            names = self._parse_names(on.group(1), schema) if on else []
+        elif action in ('DROP', 'RENAME'):
+            names = []
+            for part in rest.split(','):
+                for sub in re.split(r'\bTO\b', part, flags=re.I):
+                    names.extend(self._parse_names(sub, schema))
+        else:
+            names = self._parse_names(rest, schema)
+        if not names:
+            self.clear()
+        for db, table in names:
+            self.invalidate(db, table)
+
+    @staticmethod
+    def _parse_names(text, schema):
+        """Return [(schema, table)] of the table name at the head of text"""
+        m = DDL_NAME_RE.match(text)
+        if m is None:
+            return []
+        if m.group(2) is None:
+            return [(schema, m.group(1).strip('`'))]
+        return [(m.group(1).strip('`'), m.group(2).strip('`'))]
+
+    def load(self):
+        try:
+            with open(self.snapshot_file, 'r', encoding='utf8') as f:
+                snapshot = json.load(f)
+        except ValueError:
+            if self.offline:
+                raise
+            logger.warning(f'Ignore broken schema cache file: {self.snapshot_file}')
+            return
+        if self.offline:
+            self.binlog_checksum = snapshot.get('binlog_checksum')
+        elif snapshot.get('source') != self.source or \
+                snapshot.get('ignore_virtual_columns') != self.ignore_virtual_columns:
+            return
+        for db, tables in snapshot.get('tables', {}).items():
+            for table, columns in tables.items():
+                if self.ignore_virtual_columns and not snapshot.get('ignore_virtual_columns'):
+                    columns = [c for c in columns if c.get('EXTRA') != 'VIRTUAL GENERATED']
+                self._tables[(db, table)] = columns
+
+    def save(self):
+        if not self.snapshot_file or not self._dirty or self.offline or not self.persist:
+            return
+        tables = {}
+        for (db, table), columns in self._tables.items():
+            tables.setdefault(db, {})[table] = columns
+        snapshot = {'source': self.source, 'ignore_virtual_columns': self.ignore_virtual_columns, 'tables': tables}
+        tmp_file = self.snapshot_file + '.tmp.%s' % os.getpid()
+        with open(tmp_file, 'w', encoding='utf8') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_file, self.snapshot_file)
+        self._dirty = False
+
+
+class OfflineCtlConnection(object):
+    """Stand-in for the ctl connection in offline mode, BinLogPacketWrapper only needs charset and
+    _get_table_information of it"""
+
+    def __init__(self, charset='utf8mb4'):
+        self.charset = charset
+        self._get_table_information = None
+
+    def close(self):
+        pass
+
+
+def offline_connection(connection_settings):
+    """
+    pymysql connection which never connects to the server, only used to escape values,
+    assume the server does not set NO_BACKSLASH_ESCAPES.
+    """
+    connection = pymysql.connect(**connection_settings, defer_connect=True)
+    connection.server_status = 0
+    return connection
+
+
+def export_schema_snapshot(connection_settings, snapshot_file, only_schemas=None):
+    """
+    Save columns (COLUMN_KEY holds primary keys) of all user tables and binlog_checksum of the server into
+    snapshot_file, which could be used by --schema-snapshot to decode binlog files without connecting to MySQL.
+    """
+    settings = dict(connection_settings, db='information_schema', cursorclass=DictCursor)
+    settings.setdefault('charset', 'utf8mb4')
+    conn = pymysql.connect(**settings)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SHOW GLOBAL VARIABLES LIKE 'BINLOG_CHECKSUM'")
+            result = cursor.fetchone()
+            binlog_checksum = result.get('Value', 'NONE') if result else 'NONE'
+
+            sql = """
+                SELECT
+                    TABLE_SCHEMA, TABLE_NAME,
+                    COLUMN_NAME, COLLATION_NAME, CHARACTER_SET_NAME,
+                    COLUMN_COMMENT, COLUMN_TYPE, COLUMN_KEY, ORDINAL_POSITION,
+                    DATA_TYPE, CHARACTER_OCTET_LENGTH, EXTRA
+                FROM
+                    information_schema.columns
+                WHERE
+                    table_schema NOT IN ('information_schema', 'performance_schema', 'mysql', 'sys')
+            """
+            if only_schemas:
+                sql += " AND table_schema IN (%s)" % ', '.join(['%s'] * len(only_schemas))
+            sql += " ORDER BY TABLE_SCHEMA, TABLE_NAME, ORDINAL_POSITION"
+            cursor.execute(sql, only_schemas or None)
+            rows = cursor.fetchall()
+    finally:
+        conn.close()
+
+    tables = {}
+    for row in rows:
+        db, table = row.pop('TABLE_SCHEMA'), row.pop('TABLE_NAME')
+        tables.setdefault(db, {}).setdefault(table, []).append(row)
+    snapshot = {'source': '%s:%s' % (connection_settings['host'], connection_settings['port']),
+                'binlog_checksum': binlog_checksum, 'ignore_virtual_columns': False, 'tables': tables}
+    tmp_file = snapshot_file + '.tmp.%s' % os.getpid()
+    with open(tmp_file, 'w', encoding='utf8') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_file, snapshot_file)
+    return sum(len(t) for t in tables.values())
+
+
+# binlog index 中作为事务起点的事件
+TRX_START_EVENTS = frozenset([GTID_LOG_EVENT, ANONYMOUS_GTID_LOG_EVENT, MARIADB_GTID_EVENT])
+BINLOG_INDEX_VERSION = 1
+
+
+def new_binlog_index():
+    """
+    Columnar index of transaction start events in a binlog file, one entry per transaction (or standalone query):
+    offsets: event offset; timestamps: max event timestamp until the next entry; types: event type;
+    gtids: gtid of GTID_LOG_EVENT, else None.
+    scanned/last_type/in_trx/tail keep the scan state, so the index could be extended when the file grows.
+    """
+    return {'version': BINLOG_INDEX_VERSION, 'inode': 0, 'size': 0, 'mtime': 0, 'scanned': 4, 'last_type': 0,
+            'in_trx': False, 'tail': [4, ''], 'offsets': [], 'timestamps': [], 'types': [], 'gtids': []}
+
+
+def scan_binlog_index(file_path, index):
+    """Extend index from index['scanned'] to the last complete event in file, only event headers are read"""
+    with open(file_path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        index['inode'], index['size'], index['mtime'] = st.st_ino, st.st_size, st.st_mtime
+        if st.st_size <= index['scanned']:
+            return index
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:4] != BinLogFileReader._expected_magic:
+                raise BadMagicBytesError('Magic bytes {0!r} did not match expected {1!r}'.format(
+                    mm[:4], BinLogFileReader._expected_magic))
+            tail_pos, tail_header = index['tail']
+            if tail_header and mm[tail_pos:tail_pos + 19].hex() != tail_header:
+                # 文件被重写而不是追加，重新扫描
+                index.update(new_binlog_index())
+            offsets, timestamps, types, gtids = index['offsets'], index['timestamps'], index['types'], index['gtids']
+            pos, size = index['scanned'], len(mm)
+            last_type, in_trx = index['last_type'], index['in_trx']
+            while pos + 19 <= size:
+                timestamp, event_type, _, event_size = struct.unpack_from('<IBII', mm, pos)
+                if event_size < 19:
+                    raise EventSizeTooSmallError('Event size %s at pos %s' % (event_size, pos))
+                if pos + event_size > size:
+                    break
+
+                if event_type == QUERY_EVENT:
+                    status_vars_length, = struct.unpack_from('<H', mm, pos + 30)
+                    query_pos = pos + 32 + status_vars_length + mm[pos + 27] + 1
+                    query = mm[query_pos:min(query_pos + 8, pos + event_size)]
+                else:
+                    query = b''
+
+                if event_type in TRX_START_EVENTS or \
+                        (event_type == QUERY_EVENT and last_type not in TRX_START_EVENTS and not in_trx):
+                    gtid = None
+                    if event_type == GTID_LOG_EVENT:
+                        nibbles = mm[pos + 20:pos + 36].hex()
+                        gtid = '%s-%s-%s-%s-%s:%d' % (nibbles[:8], nibbles[8:12], nibbles[12:16], nibbles[16:20],
+                                                      nibbles[20:], struct.unpack_from('<Q', mm, pos + 36)[0])
+                    offsets.append(pos)
+                    timestamps.append(timestamp)
+                    types.append(event_type)
+                    gtids.append(gtid)
+                elif timestamps and timestamp > timestamps[-1]:
+                    timestamps[-1] = timestamp
+
+                if query.startswith(b'BEGIN'):
+                    in_trx = True
+                elif event_type == XID_EVENT or query.startswith(b'COMMIT') or query.startswith(b'ROLLBACK'):
+                    in_trx = False
+                last_type = event_type
+                index['tail'] = [pos, mm[pos:pos + 19].hex()]
+                pos += event_size
+            index['scanned'], index['last_type'], index['in_trx'] = pos, last_type, in_trx
+    return index
+
+
+def load_binlog_index(file_path, index_dir):
+    """Load the binlog index cached in index_dir, build or extend it if the binlog file has changed"""
+    abs_path = os.path.abspath(file_path)
+    index_file = os.path.join(index_dir, '%s.%s.json' % (
+        abs_path.split(sep)[-1], hashlib.md5(abs_path.encode('utf8')).hexdigest()[:8]))
+    st = os.stat(file_path)
+
+    index = None
+    if os.path.exists(index_file):
+        try:
+            with open(index_file, 'r', encoding='utf8') as f:
+                index = json.load(f)
+        except ValueError:
+            index = None
+    if index and index.get('version') == BINLOG_INDEX_VERSION and index['inode'] == st.st_ino and \
+            index['scanned'] <= st.st_size:
+        if index['size'] == st.st_size and index['mtime'] == st.st_mtime:
+            return index
+    else:
+        index = new_binlog_index()
+
+    scan_binlog_index(file_path, index)
+    os.makedirs(index_dir, exist_ok=True)
+    tmp_file = index_file + '.tmp.%s' % os.getpid()
+    with open(tmp_file, 'w', encoding='utf8') as f:
+        json.dump(index, f)
+    os.replace(tmp_file, index_file)
+    return index
+
+
+def binlog_index_seek(index, start_pos=None, start_ts=None, gtid_set=None):
+    """
+    Return offset of the first transaction start event which may contain wanted events, 4 if nothing to skip.
+    Every event before it has end pos < start_pos, timestamp < start_ts, or an unwanted gtid.
+    """
+    offsets, timestamps, gtids = index['offsets'], index['timestamps'], index['gtids']
+    if not offsets:
+        return 4
+    last = len(offsets) - 1
+    bound = -1
+    if start_pos:
+        # 包含 start_pos 的事件一定在 offset < start_pos 的最后一个事务内
+        bound = max(bound, bisect.bisect_left(offsets, start_pos) - 1)
+    if start_ts is not None:
+        bound = max(bound, next((i for i, ts in enumerate(timestamps) if ts >= start_ts), last))
+    if gtid_set:
+        seen_gtid = False
+        for i, gtid in enumerate(gtids):
+            if (gtid is None and not seen_gtid) or (gtid is not None and is_want_gtid(gtid_set, gtid)):
+                break
+            seen_gtid = seen_gtid or gtid is not None
+        else:
+            i = last
+        bound = max(bound, i)
+    return offsets[bound] if bound >= 0 else 4
+
+
 def parse_args():
     """parse args for binlog2sql"""
     parser = argparse.ArgumentParser(description='Parse MySQL binlog file to SQL you want', add_help=False,
@@ -370,6 +997,22 @@ def parse_args():
     binlog_file_filter.add_argument('-ma', '--minutes-ago', dest='minutes_ago', type=int, default=3,
                                     help='When you use --stop-never, we only parse specify minutes ago of '
                                          'modify time of file.')
+    binlog_file_filter.add_argument('--no-binlog-index', dest='no_binlog_index', action='store_true', default=False,
+                                    help="Don't build event index of binlog files (cached in --tmp-dir) to seek "
+                                         "directly to --start-pos, --start-datetime or --include-gtid.")
+    binlog_file_filter.add_argument('--schema-cache-file', dest='schema_cache_file', type=str, default='',
+                                    help='Save table columns got from information_schema into this file and reuse '
+                                         'them in next run. Cached tables are dropped when DDL of them is parsed. '
+                                         'With --workers the file is only read by the worker processes.')
+    binlog_file_filter.add_argument('--export-schema-snapshot', dest='export_schema_snapshot', type=str, default='',
+                                    help='Export table columns and binlog_checksum of the server (only databases of '
+                                         '--databases if given) into this file, then exit.')
+    binlog_file_filter.add_argument('--schema-snapshot', dest='schema_snapshot', type=str, default='',
+                                    help='Decode binlog files offline with a file from --export-schema-snapshot, '
+                                         "we won't connect to MySQL server (except --sync target).")
+    binlog_file_filter.add_argument('-w', '--workers', dest='workers', type=int, default=0,
+                                    help='Parse binlog files in N processes, the result is still output in file '
+                                         'order. Could not work with --flashback, --sync or --table-per-file.')
 
     return parser
 
@@ -395,11 +1038,21 @@ def command_line_args(args):
         raise ValueError('Only one of flashback or stop-never can be True')
     if args.flashback and args.no_pk:
         raise ValueError('Only one of flashback or nopk can be True')
+    if args.workers > 1 and (args.flashback or args.sync or args.table_per_file):
+        raise ValueError('--workers could not work with --flashback, --sync or --table-per-file')
+    if args.max_statement_size < 1:
+        raise ValueError('--max-statement-size must be greater than 0')
+    if args.sync_workers < 1:
+        raise ValueError('--sync-workers must be greater than 0')
     if (args.start_time and not is_valid_datetime(args.start_time)) or (
             args.stop_time and not is_valid_datetime(args.stop_time)):
         raise ValueError('Incorrect datetime argument')
+    if args.schema_snapshot and (args.schema_cache_file or args.export_schema_snapshot):
+        raise ValueError('--schema-snapshot could not work with --schema-cache-file or --export-schema-snapshot')
     if not args.check:
-        if not args.password:
+        if args.schema_snapshot:
+            args.password = ''
+        elif not args.password:
             args.password = getpass.getpass('Password: ')
         else:
             args.password = args.password[0]
@@ -77,6 +77,22 @@ def save_executed_result(result_file, result_list):
     return
 
 
+def concat_result_files(result_files, f_dst, remove=True):
+    """Copy result files into opened file f_dst in order"""
+    for result_file in result_files:
+        if not os.path.exists(result_file):
+            continue
+        with open(result_file, 'r', encoding='utf8') as f:
+            while True:
+                chunk = f.read(1024 * 1024)
+                if not chunk:
+                    break
+                f_dst.write(chunk)
+        if remove:
+            os.remove(result_file)
+    return
+
+
 def get_binlog_file_list(args):
     binlog_file_list = []
     executed_file_list = read_file(args.record_file) if args.stop_never and os.path.exists(args.record_file) else []
@@ -1,6 +1,9 @@
 require 'fluent/plugin/input'
 require 'open3'
+require 'tempfile'
+require 'json'
 require 'mysql2'
+require_relative 'mysql_binlog_checkpoint'
 
 module Fluent::Plugin
   class MysqlInBinlogInput < Input
@@ -17,17 +20,42 @@ module Fluent::Plugin
     config_param :buffer_file_path, :string, :default => '/var/log/fluentd/mysql_binlog.in.buffer'
 
     config_param :only_dml, :bool, :default => true
+    # 流模式：只启动一个常驻的 binlog2sql.py --stream 进程，持续读取事件，不再按 interval 周期拉起进程
+    config_param :stream_mode, :bool, :default => false
+    # binlog2sql.py 的输出格式：sql 为带 "#start ... end ..." 注释的 SQL 文本；json 为每行一个 JSON 对象，字段更丰富且无需字符串解析
+    config_param :output_format, :enum, :list => [:sql, :json], :default => :sql
+    # 注册为 slave 时使用的 server_id 范围，如 1001-1100。配置后每个同步进程分配一个独立的 server_id，多个 binlog 文件可并行同步
+    config_param :server_id_range, :string, :default => nil
+    # 流模式下，积压的已关闭 binlog 文件由 binlog2sql.py 以多少个进程并行解析，解析结果仍按文件顺序输出。0 表示不并行；
+    # 大于 1 时需要配置 server_id_range，每个进程使用其中不同的 server_id
+    config_param :catch_up_workers, :integer, :default => 0
+    # 一个 insert 事件的多行数据合并为一条多 VALUES 的 INSERT/REPLACE 发出，单条语句不超过 max_statement_size 字节
+    config_param :batch_insert, :bool, :default => false
+    config_param :max_statement_size, :integer, :default => 1048576
+    # 流模式下按 GTID 续传：已执行的 GTID 集合保存在 buffer_file_path + '.gtid' 中，重启时以 binlog2sql.py --auto-position 启动，
+    # 由源库定位第一个未执行的事务，不会从事务中间开始读，切换到其他源库也无需重新扫描。首次启动(没有 .gtid 文件)时仍按 binlog 位点启动
+    config_param :auto_position, :bool, :default => false
 
     def initialize
       super
 
       @binlog_files = {}
-      @binlog_files_update_flag = false
+      # sync_flag 为 1 的 binlog 文件，随 sync_flag 的变化增量维护，run_sync 只遍历这些文件
+      @active_binlog_files = {}
+      @current_binlog_file = nil
 
 	  @mutex_binlog_list = Mutex.new
 
+      @control_client = nil
+      @mutex_control_client = Mutex.new
+
       @mutex_binlog_sync = Mutex.new
       @mysql_sync_safe_flag = nil
+
+      @stream_io = nil
+
+      @mutex_server_id = Mutex.new
+      @server_ids_in_use = {}
     end
 
     def configure(conf)
@@ -36,28 +64,55 @@ module Fluent::Plugin
       if @interval == 0
         @interval = 30
       end
+
+      if !@server_id_range.nil?
+        @server_id_min, @server_id_max = @server_id_range.split('-').map(&:to_i)
+        @server_id_max ||= @server_id_min
+        if @server_id_min <= 0 || @server_id_max < @server_id_min
+          raise Fluent::ConfigError, "invalid server_id_range : #{@server_id_range}"
+        end
+      end
+
+      if @auto_position && !@stream_mode
+        raise Fluent::ConfigError, "auto_position only works with stream_mode"
+      end
+
+      if @stream_mode && !@auto_position && @catch_up_workers > 1 && @server_id_range.nil?
+        raise Fluent::ConfigError, "catch_up_workers needs server_id_range, every worker uses a server_id of it"
+      end
     end
 
    def start
       super
 
+      @checkpoint = MysqlBinlogCheckpoint.new(@buffer_file_path)
       load_binlog_offsets_from_buffer_file
+      load_executed_gtid_set
 
       @threads = {}
 
-      @buffer_thread_1 = Thread.new { run_sync }
+      if @stream_mode
+        @buffer_thread_1 = Thread.new { run_stream }
+      else
+        @buffer_thread_1 = Thread.new { run_sync }
+      end
       @buffer_thread_2 = Thread.new { run_sync_info_save }
-      @buffer_thread_3 = Thread.new { run_merge_binlog_files }
+      # 流模式通过 rotate 行感知新文件，无需周期性拉取 binlog 列表
+      if !@stream_mode
+        @buffer_thread_3 = Thread.new { run_merge_binlog_files }
+      end
     end
 
 
     def shutdown
       super
+      stop_stream
       @threads.each_value(&:terminate)
       @threads.each_value(&:join)
 
-      @binlog_files_update_flag = true
-      write_binlog_offsets_to_buffer_file
+      close_control_client
+      @checkpoint.close
+      write_executed_gtid_set
     end
 
 
@@ -67,15 +122,16 @@ module Fluent::Plugin
     def run_sync
       sleep 1
       loop do
-        @binlog_files.each do |log_file, v|
-          if @binlog_files[log_file]["sync_flag"] == 1
-            if @binlog_files[log_file]["thread_id"].nil? || (@binlog_files[log_file]["thread_id"] == 0)
-              @threads[log_file] = Thread.new do
-                begin
-                  run_binlog_sync(log_file)
-                rescue => e
-                  log.error "run_binlog_sync fail : #{e.message}"
-                end
+        # 已结束的同步线程不再保留
+        @threads.delete_if { |log_file, thread| !thread.alive? }
+        @active_binlog_files.keys.each do |log_file|
+          next if @binlog_files[log_file].nil?
+          if @binlog_files[log_file]["thread_id"].nil? || (@binlog_files[log_file]["thread_id"] == 0)
+            @threads[log_file] = Thread.new do
+              begin
+                run_binlog_sync(log_file)
+              rescue => e
+                log.error "run_binlog_sync fail : #{e.message}"
               end
             end
           end
@@ -85,9 +141,49 @@ module Fluent::Plugin
     end
 
 
+    def run_stream
+      sleep 1
+      loop do
+        begin
+          # 只在进程(重新)启动时全量拉取一次 binlog 列表，之后由 rotate 行增量维护
+          merge_all_binlog_files
+          log_file, offset = stream_start_position
+          if !log_file.nil?
+            run_binlog_stream(log_file, offset)
+          end
+        rescue => e
+          log.error "run_binlog_stream fail : #{e.message}"
+        end
+        sleep interval
+      end
+    end
+
+
+    def stream_start_position
+      log_files = @binlog_files.keys.sort
+      log_file = log_files.find { |f| @binlog_files[f]["sync_flag"] == 1 } || log_files.last
+      return nil, 0 if log_file.nil?
+      return log_file, @binlog_files[log_file]["offset_sync"]
+    end
+
+
+    def stop_stream
+      if !@stream_io.nil?
+        begin
+          Process.kill(:TERM, @stream_io.pid)
+        rescue Errno::ESRCH
+        end
+      end
+    end
+
+
     def run_merge_binlog_files
       loop do
-        merge_binlog_files
+        begin
+          merge_binlog_files
+        rescue => e
+          log.error "merge_binlog_files fail : #{e.message}"
+        end
         sleep 30
       end
     end
@@ -95,76 +191,147 @@ module Fluent::Plugin
 
     def run_sync_info_save
       loop do
-        sleep 60 
+        sleep 10
         write_binlog_offsets_to_buffer_file
       end
     end
 
 
+    # 每个周期只查询 SHOW MASTER STATUS 更新当前写入的文件；发生切换(或首次)时才全量拉取 binlog 列表。
+    # 已关闭的文件大小不再变化，其 sync_flag 由同步线程在读完后清除
     def merge_binlog_files
+      current_file, current_position = fetch_master_status
+      if current_file.nil? || current_file != @current_binlog_file || @binlog_files[current_file].nil?
+        merge_all_binlog_files
+        @current_binlog_file = current_file
+      else
+        merge_binlog_file(current_file, current_position, Time.now.to_i)
+      end
+    end
+
+
+    def merge_all_binlog_files
       current_timestamp = Time.now.to_i
-      fetch_sync_files.each do |log_file, offset_binlog|
-        if @binlog_files[log_file].nil?
-          offset_sync = 0
-          @binlog_files[log_file] = { "log_file"=>log_file, "offset_sync"=>0, "offset_binlog"=>offset_binlog, "sync_flag"=>1, "sync_time"=>current_timestamp }
-          log.info("new binlog file : #{log_file}")
-        else
-          offset_sync = @binlog_files[log_file]["offset_sync"]
-          @binlog_files[log_file]["sync_time"] = current_timestamp
-          @binlog_files[log_file]["offset_binlog"] = offset_binlog
-        end
+      sync_files = fetch_sync_files
+      # 未开启 binlog 等情况下列表为空，不据此清理已有记录
+      return if sync_files.empty?
+      sync_files.each do |log_file, offset_binlog|
+        merge_binlog_file(log_file, offset_binlog, current_timestamp)
+      end
 
-        if (offset_binlog > 0)
-          if offset_binlog > offset_sync
-            @binlog_files[log_file]["sync_flag"] = 1
-          else
-            @binlog_files[log_file]["sync_flag"] = 0
-          end
+      @binlog_files.keys.each do |log_file|
+        if !sync_files.key?(log_file)
+          set_sync_flag(log_file, 0)
+          retire_binlog_file(log_file)
         end
       end
+    end
+
+
+    # 服务端已不再列出(已 purge)且没有同步线程在运行的文件，从内存和缓冲文件中移除，
+    # 使每周期的工作量和缓冲文件大小只与仍存在的文件数相关。已结束的线程由 run_sync 清理。
+    # 未同步完就被 purge 的文件已无法再读取，移除前打印告警，提示其余部分的数据已丢失
+    def retire_binlog_file(log_file)
+      thread = @threads[log_file]
+      return if !thread.nil? && thread.alive?
+
+      offset_sync = @binlog_files[log_file]["offset_sync"].to_i
+      offset_binlog = @binlog_files[log_file]["offset_binlog"].to_i
+      if offset_sync < offset_binlog
+        log.warn("binlog file #{log_file} was purged before it was fully synced, " \
+                 "events from offset #{offset_sync} to #{offset_binlog} are lost")
+      end
+      @binlog_files.delete(log_file)
+      @checkpoint.delete(log_file)
+      log.info("retire binlog file : #{log_file}")
+    end
+
+
+    def merge_binlog_file(log_file, offset_binlog, current_timestamp)
+      if @binlog_files[log_file].nil?
+        offset_sync = 0
+        @binlog_files[log_file] = { "log_file"=>log_file, "offset_sync"=>0, "offset_binlog"=>offset_binlog, "sync_flag"=>0, "sync_time"=>current_timestamp }
+        set_sync_flag(log_file, 1)
+        log.info("new binlog file : #{log_file}")
+      else
+        offset_sync = @binlog_files[log_file]["offset_sync"]
+        @binlog_files[log_file]["sync_time"] = current_timestamp
+        @binlog_files[log_file]["offset_binlog"] = offset_binlog
+      end
 
-      @binlog_files.each do |log_file, v|
-        if @binlog_files[log_file]["sync_time"] != current_timestamp
-          @binlog_files[log_file]["sync_flag"] = 0
+      if (offset_binlog > 0)
+        if offset_binlog > offset_sync
+          set_sync_flag(log_file, 1)
+        else
+          set_sync_flag(log_file, 0)
         end
       end
     end
 
 
+    def set_sync_flag(log_file, sync_flag)
+      @binlog_files[log_file]["sync_flag"] = sync_flag
+      if sync_flag == 1
+        @active_binlog_files[log_file] = true
+      else
+        @active_binlog_files.delete(log_file)
+      end
+    end
+
+
+    # 只追加有变化的 binlog_file 的 offset，见 MysqlBinlogCheckpoint
     def write_binlog_offsets_to_buffer_file
-      if @binlog_files_update_flag
-        if File.exist?(@buffer_file_path)
-          FileUtils.cp(@buffer_file_path, "#{@buffer_file_path}.bak")
-        end
+      @checkpoint.flush(true)
+      write_executed_gtid_set
+    end
 
-        File.open(@buffer_file_path, 'w') do |file|
-          @binlog_files.each do |binlog_file, valueInJson|
-            file.puts "#{binlog_file}=#{valueInJson["offset_sync"]}"
-          end
-        end
-        @binlog_files_update_flag = false
+
+    def load_executed_gtid_set
+      return if !@auto_position
+      @gtid_file_path = "#{@buffer_file_path}.gtid"
+      @executed_gtid_set = File.exist?(@gtid_file_path) ? File.read(@gtid_file_path).strip : nil
+      @executed_gtid_set = nil if !@executed_gtid_set.nil? && @executed_gtid_set.empty?
+      @saved_gtid_set = @executed_gtid_set
+    end
+
+
+    # 已执行的 GTID 集合有变化时写临时文件后 rename 替换
+    def write_executed_gtid_set
+      return if !@auto_position
+      gtid_set = @executed_gtid_set
+      return if gtid_set.nil? || gtid_set == @saved_gtid_set
+
+      tmp_path = "#{@gtid_file_path}.tmp"
+      File.open(tmp_path, 'w') do |file|
+        file.write("#{gtid_set}\n")
+        file.flush
+        file.fsync
       end
+      File.rename(tmp_path, @gtid_file_path)
+      @saved_gtid_set = gtid_set
     end
 
 
     def load_binlog_offsets_from_buffer_file
-      begin
-        # each line: key=value
-        File.foreach(@buffer_file_path) do |line|
-          key, value = line.chomp.split('=')
-          @binlog_files[key] = { "log_file"=>key, "offset_sync"=>value.to_i, "offset_binlog"=>0, "sync_flag"=>0, "sync_time"=>0}
-        end
-      rescue Errno::ENOENT
+      if !File.exist?(@buffer_file_path)
         log.warn "Buffer file '#{@buffer_file_path}' not found. Starting with empty offsets."
       end
+      # each line: key=value
+      @checkpoint.load.each do |key, value|
+        @binlog_files[key] = { "log_file"=>key, "offset_sync"=>value.to_i, "offset_binlog"=>0, "sync_flag"=>0, "sync_time"=>0}
+      end
     end
 
 
-    def getRunCommand(log_file, offset)
+    def getRunCommand(log_file, offset, server_id = nil)
       cur_run_path = File.dirname(__FILE__)
       script="#{cur_run_path}/../../../binlog2sql/binlog2sql.py"
       command = "#{script} -h #{@host} -P #{@port} -u #{@username}  -p #{@password} --start-file=#{log_file} --start-pos=#{offset} "
 
+      if !server_id.nil?
+          command += " --server-id=#{server_id} "
+      end
+
       if !@database.nil? && !@database.empty?
           command += " -d #{@database} "
       end
@@ -174,6 +341,12 @@ module Fluent::Plugin
       if @only_dml
           command += "  --only-dml "
       end
+      if @output_format == :json
+          command += " --output-format json "
+      end
+      if @batch_insert
+          command += " --batch-insert --max-statement-size=#{@max_statement_size} "
+      end
 
       return  command
     end
@@ -216,6 +389,46 @@ module Fluent::Plugin
     end
 
 
+    def acquire_server_id
+      @mutex_server_id.synchronize do
+        (@server_id_min..@server_id_max).each do |server_id|
+          if !@server_ids_in_use[server_id]
+            @server_ids_in_use[server_id] = true
+            return server_id
+          end
+        end
+      end
+      return nil
+    end
+
+
+    def release_server_id(server_id)
+      return if server_id.nil?
+      @mutex_server_id.synchronize do
+        @server_ids_in_use.delete(server_id)
+      end
+    end
+
+
+    # 未配置 server_id_range 时，所有进程共用源库的 server_id，只能串行；配置后各自分配 server_id，可并行
+    def acquire_sync_slot(thread_id)
+      if @server_id_range.nil?
+        return safe_lock(thread_id), nil
+      end
+      server_id = acquire_server_id
+      return server_id, server_id
+    end
+
+
+    def release_sync_slot(thread_id, server_id)
+      if @server_id_range.nil?
+        safe_unlock(thread_id)
+      else
+        release_server_id(server_id)
+      end
+    end
+
+
     def run_binlog_sync(log_file)
       thread_id = Thread.current.object_id
       @binlog_files[log_file]["thread_id"] = thread_id
@@ -231,49 +444,54 @@ module Fluent::Plugin
             @binlog_files[log_file]["offset_sync"] = offset_sync
         end
 
-        command = getRunCommand(log_file, offset_sync)
         sync_counter = -1
+        server_id = nil
+        spool = nil
 
         begin
-          try_lock = safe_lock(thread_id)
+          try_lock, server_id = acquire_sync_slot(thread_id)
           if !try_lock.nil?
+            command = getRunCommand(log_file, offset_sync, server_id)
             log.info(" thread : #{thread_id}, binlog : #{log_file}, run : #{command}")
 
-            sync_counter = 0
             stdout = IO.popen("#{command}")
-            stdout.each_line do |line|
-              line_statement = line.chomp
-              parts = line_statement.split("; #start")
-              next if parts.length == 1
-
-              sql = parts[0]
-              offset_sync = parts[1].match(/end (\d+)/)[1].to_i
-
-              router.emit(@tag, Fluent::Engine.now, {'sql' => sql, 'binlog_file'=>log_file, 'offset' => offset_sync})
-              sync_counter += 1
-
-              if offset_sync > @binlog_files[log_file]["offset_sync"]
-                @binlog_files[log_file]["offset_sync"] = offset_sync
-                @binlog_files_update_flag = true
-              end
+            if earliest_pending_binlog_file?(log_file)
+              sync_counter = emit_binlog_lines(log_file, stdout)
+            else
+              # 更早的文件还未同步完，解析结果先写入临时文件，释放 server_id 后再按文件顺序发出
+              spool = Tempfile.new('mysql_binlog_spool')
+              IO.copy_stream(stdout, spool)
             end
+            stdout.close
           end
         rescue => e
           log.error("Error processing binlog #{log_file} : #{e.message}")
         ensure
-          safe_unlock(thread_id)
+          release_sync_slot(thread_id, server_id)
+        end
+
+        if !spool.nil?
+          begin
+            sleep 1 until earliest_pending_binlog_file?(log_file)
+            spool.rewind
+            sync_counter = emit_binlog_lines(log_file, spool)
+          rescue => e
+            log.error("Error processing binlog #{log_file} : #{e.message}")
+          ensure
+            spool.close!
+          end
         end
 
         if sync_counter == 0
           @binlog_files[log_file]["offset_sync"] = offset_binlog
-          @binlog_files_update_flag = true
-          @binlog_files[log_file]["sync_flag"] = 0
+          @checkpoint.update(log_file, offset_binlog)
+          set_sync_flag(log_file, 0)
         end
 
         if @binlog_files[log_file]["sync_flag"] == 1
           sleep @interval
         else
-          log.info("[run sync stop] log_file:#{log_file}, offset_sync:#{offset_sync}, offset_binlog:#{offset_binlog}, thread_id:#{thread_id}")
+          log.info("[run sync stop] log_file:#{log_file}, offset_sync:#{@binlog_files[log_file]["offset_sync"]}, offset_binlog:#{offset_binlog}, thread_id:#{thread_id}")
           @binlog_files[log_file]["thread_id"] = 0
           break
         end
@@ -281,17 +499,208 @@ module Fluent::Plugin
     end
 
 
+    # 多个文件可以并行解析(server_id_range)，但只有最早的待同步文件可以发出记录，保证跨文件仍按源库顺序写入：
+    # output 按顺序应用，position_table 每张表只记录一个已应用位置，乱序会使较早的记录被当作已应用而跳过
+    def earliest_pending_binlog_file?(log_file)
+      @active_binlog_files.keys.none? { |f| f < log_file }
+    end
+
+
+    # 发出 binlog2sql.py 的输出并推进 offset，返回发出的记录数
+    def emit_binlog_lines(log_file, io)
+      sync_counter = 0
+      seq = 0
+      last_offset = nil
+      io.each_line do |line|
+        record = parse_binlog_line(line)
+        next if record.nil? || record["sql"].nil?
+
+        offset_sync = record["end"]
+        # 同一个事件的多行数据 offset 相同，用 seq 区分，供 output 去重
+        seq = offset_sync == last_offset ? seq + 1 : 0
+        last_offset = offset_sync
+        router.emit(@tag, Fluent::Engine.now, build_emit_record(record, log_file, seq))
+        sync_counter += 1
+
+        if offset_sync > @binlog_files[log_file]["offset_sync"]
+          @binlog_files[log_file]["offset_sync"] = offset_sync
+          @checkpoint.update(log_file, offset_sync)
+        end
+      end
+      return sync_counter
+    end
+
+
+    # 解析 binlog2sql.py 输出的一行，返回 Hash；非事件行(日志等)返回 nil
+    def parse_binlog_line(line)
+      line_statement = line.chomp
+
+      if @output_format == :json
+        begin
+          record = JSON.parse(line_statement)
+        rescue JSON::ParserError
+          return nil
+        end
+        return record.is_a?(Hash) ? record : nil
+      end
+
+      if line_statement.start_with?("# rotate ")
+        _, _, log_file, position = line_statement.split(" ")
+        return { "type"=>"ROTATE", "binlog_file"=>log_file, "end"=>position.to_i }
+      end
+
+      if line_statement.start_with?("# commit ")
+        _, _, log_file, position, gtid_set = line_statement.split(" ")
+        return { "type"=>"COMMIT", "binlog_file"=>log_file, "end"=>position.to_i, "executed_gtid_set"=>gtid_set }
+      end
+
+      parts = line_statement.split("; #start")
+      return nil if parts.length == 1
+
+      return { "sql"=>parts[0], "end"=>parts[1].match(/end (\d+)/)[1].to_i }
+    end
+
+
+    # source、binlog_file、offset、seq 唯一确定一条记录，output 据此跳过已应用的记录
+    def build_emit_record(record, log_file, seq = 0)
+      emit_record = { 'sql' => record["sql"], 'binlog_file' => log_file, 'offset' => record["end"],
+                      'source' => "#{@host}:#{@port}", 'seq' => seq }
+      ["db", "table", "type", "start", "gtid", "timestamp"].each do |key|
+        emit_record[key] = record[key] if record.key?(key)
+      end
+      return emit_record
+    end
+
+
+    # 常驻进程模式：进程内持续阻塞读取 binlog，通过 "# rotate <file> <pos>" 行感知 binlog 文件切换
+    def run_binlog_stream(log_file, offset)
+      server_id = nil
+      if !@server_id_range.nil?
+        server_id = acquire_server_id
+      end
+      command = getRunCommand(log_file, offset, server_id) + " --stream "
+      if @auto_position
+        if @executed_gtid_set.nil?
+          command += " --gtid-markers "
+        else
+          command += " --auto-position=#{@executed_gtid_set} "
+        end
+      elsif @catch_up_workers > 1
+        command += " --catch-up-workers=#{@catch_up_workers} "
+        command += " --server-id-range=#{@server_id_range} "
+      end
+      log.info("[stream start] log_file:#{log_file}, offset_sync:#{offset}, server_id:#{server_id}, executed_gtid_set:#{@executed_gtid_set}")
+
+      begin
+        IO.popen("#{command}") do |stdout|
+          @stream_io = stdout
+          seq = 0
+          last_offset = nil
+          stdout.each_line do |line|
+            record = parse_binlog_line(line)
+            next if record.nil?
+
+            # 事务结束，记录已执行的 GTID 集合
+            if record["type"] == "COMMIT"
+              @executed_gtid_set = record["executed_gtid_set"]
+              next
+            end
+
+            if record["type"] == "ROTATE"
+              # 切换到新文件后上一个文件已读完
+              finish_binlog_file(log_file) if record["binlog_file"] != log_file && !@binlog_files[log_file].nil?
+              log_file = record["binlog_file"]
+              if @binlog_files[log_file].nil?
+                @binlog_files[log_file] = { "log_file"=>log_file, "offset_sync"=>0, "offset_binlog"=>0, "sync_flag"=>0, "sync_time"=>Time.now.to_i }
+                log.info("new binlog file : #{log_file}")
+              end
+              set_sync_flag(log_file, 1)
+              last_offset = nil
+              next
+            end
+            next if record["sql"].nil?
+
+            offset_sync = record["end"]
+            seq = offset_sync == last_offset ? seq + 1 : 0
+            last_offset = offset_sync
+            router.emit(@tag, Fluent::Engine.now, build_emit_record(record, log_file, seq))
+
+            if offset_sync > @binlog_files[log_file]["offset_sync"]
+              @binlog_files[log_file]["offset_sync"] = offset_sync
+              @checkpoint.update(log_file, offset_sync)
+            end
+          end
+        end
+      ensure
+        @stream_io = nil
+        release_server_id(server_id)
+      end
+      log.warn("[stream stop] log_file:#{log_file}, exit status:#{$?.exitstatus}")
+    end
+
+
+    # 已读完的文件 offset_sync 记为文件大小：最后一条 DML 之后还有 Xid、Rotate 等事件，若停在最后一条 DML 的位点，
+    # 重启后该文件会被视为未同步完，从它开始重新读取之后所有文件；purge 时也会误报数据丢失
+    def finish_binlog_file(log_file)
+      begin
+        file_size = fetch_sync_files[log_file]
+      rescue => e
+        log.warn "fetch size of binlog file #{log_file} fail : #{e.message}"
+      end
+      binlog_file = @binlog_files[log_file]
+      binlog_file["offset_binlog"] = file_size.to_i if !file_size.nil?
+      if binlog_file["offset_binlog"] > binlog_file["offset_sync"]
+        binlog_file["offset_sync"] = binlog_file["offset_binlog"]
+        @checkpoint.update(log_file, binlog_file["offset_sync"])
+      end
+      set_sync_flag(log_file, 0)
+    end
+
+
     def fetch_sync_files
       cur_binlog_files = {}
-      client = Mysql2::Client.new(host: @host, port: @port, username: @username, password: @password)
-      result = client.query("SHOW BINARY LOGS")
+      result = control_query("SHOW BINARY LOGS")
       result.each do |row|
         cur_binlog_files[row['Log_name']] = row['File_size']
       end
       return cur_binlog_files
-      
-      ensure
-        client.close if client
+    end
+
+
+    # MySQL 8.2.0 起 SHOW BINARY LOG STATUS 替代 SHOW MASTER STATUS，8.4 移除后者
+    def fetch_master_status
+      begin
+        row = control_query(@master_status_sql ||= "SHOW MASTER STATUS").first
+      rescue Mysql2::Error
+        raise if @master_status_sql == "SHOW BINARY LOG STATUS"
+        @master_status_sql = "SHOW BINARY LOG STATUS"
+        row = control_query(@master_status_sql).first
+      end
+      return nil, 0 if row.nil?
+      return row['File'], row['Position']
+    end
+
+
+    # 查询 binlog 列表、状态复用同一个常驻连接，出错时关闭，下次查询重新连接
+    def control_query(sql)
+      @mutex_control_client.synchronize do
+        begin
+          @control_client ||= Mysql2::Client.new(host: @host, port: @port, username: @username, password: @password)
+          @control_client.query(sql)
+        rescue Mysql2::Error
+          @control_client.close rescue nil if @control_client
+          @control_client = nil
+          raise
+        end
+      end
+    end
+
+
+    def close_control_client
+      @mutex_control_client.synchronize do
+        @control_client.close if @control_client
+        @control_client = nil
       end
     end
+  end
 end
@@ -0,0 +1,116 @@
+require 'fileutils'
+
+module Fluent::Plugin
+  # binlog 位点检查点：追加写的 key=value 日志，"key=" 为删除标记，后写的记录覆盖先写的。
+  # update/delete 只记录到内存中的脏集合，flush 时只追加变化的 key，fsync 按 fsync_interval 合并；
+  # 日志行数超过 compact_threshold 且远多于有效 key 数时，写临时文件后 rename 完成压缩。
+  # 兼容原来整体重写的 key=value 缓冲文件格式。
+  class MysqlBinlogCheckpoint
+    def initialize(path, fsync_interval: 1, compact_threshold: 10000)
+      @path = path
+      @fsync_interval = fsync_interval
+      @compact_threshold = compact_threshold
+      @values = {}
+      @dirty = {}
+      @lines = 0
+      @last_fsync = 0
+      @io = nil
+      @mutex = Mutex.new
+    end
+
+    # 读取所有有效记录，返回 { key => value }。崩溃时写了一半的最后一行(没有换行符)被忽略
+    def load
+      @mutex.synchronize do
+        @values = {}
+        @lines = 0
+        if File.exist?(@path)
+          File.foreach(@path) do |line|
+            next unless line.end_with?("\n")
+            key, sep, value = line.chomp.rpartition('=')
+            next if sep.empty? || key.empty?
+            @lines += 1
+            if value.empty?
+              @values.delete(key)
+            else
+              @values[key] = value
+            end
+          end
+        end
+        @values.dup
+      end
+    end
+
+    def update(key, value)
+      @mutex.synchronize do
+        value = value.to_s
+        next if @values[key] == value
+        @values[key] = value
+        @dirty[key] = value
+      end
+    end
+
+    def delete(key)
+      @mutex.synchronize do
+        next unless @values.key?(key) || @dirty.key?(key)
+        @values.delete(key)
+        @dirty[key] = ''
+      end
+    end
+
+    # 追加脏记录；force 为 true 时立即 fsync，否则距上次 fsync 超过 fsync_interval 秒才 fsync
+    def flush(force = false)
+      @mutex.synchronize do
+        if !@dirty.empty?
+          open_log.write(@dirty.map { |key, value| "#{key}=#{value}\n" }.join)
+          @io.flush
+          @lines += @dirty.size
+          @dirty.clear
+          if @lines > @compact_threshold && @lines > @values.size * 2
+            compact
+            next
+          end
+        end
+        if @io && (force || now - @last_fsync >= @fsync_interval)
+          @io.fsync
+          @last_fsync = now
+        end
+      end
+    end
+
+    def close
+      flush(true)
+      @mutex.synchronize do
+        @io.close if @io
+        @io = nil
+      end
+    end
+
+    private
+
+    def now
+      Process.clock_gettime(Process::CLOCK_MONOTONIC)
+    end
+
+    def open_log
+      @io ||= File.open(@path, 'a')
+    end
+
+    def compact
+      tmp_path = "#{@path}.tmp"
+      File.open(tmp_path, 'w') do |file|
+        @values.each do |key, value|
+          file.write("#{key}=#{value}\n")
+        end
+        file.flush
+        file.fsync
+      end
+      @io.close if @io
+      File.rename(tmp_path, @path)
+      # rename 需要目录 fsync 才能持久化
+      File.open(File.dirname(@path)) { |dir| dir.fsync rescue nil }
+      @io = File.open(@path, 'a')
+      @lines = @values.size
+      @last_fsync = now
+    end
+  end
+end
@@ -1,5 +1,6 @@
 require 'fluent/plugin/output'
 require 'mysql2'
+require_relative 'mysql_binlog_checkpoint'
 
 module Fluent::Plugin
   class MysqlOutBinlogOutput < Output
@@ -10,61 +11,328 @@ module Fluent::Plugin
     config_param :password, :string, :default => nil, secret: true
     config_param :tag, :string, :default => 'mysql_binlog_out'
     config_param :buffer_file_path, :string, :default => '/var/log/fluentd/mysql_binlog.out.buffer'
+    # 一个 chunk 的 SQL 在同一个事务中执行，每次请求最多拼接 batch_statements 条语句
+    config_param :batch_statements, :integer, :default => 100
+    # 连接池大小，默认与 flush_thread_count 相同
+    config_param :pool_size, :integer, :default => nil
+    # 同一张表的 chunk 按顺序写入，较新的 chunk 最多等待较早的 chunk 多少秒，超时后稍后重试
+    config_param :ordering_timeout, :time, :default => 60
+    # 目标库中记录已应用位置的表，如 binlog_sync.applied_position。配置后每个 source、表已应用到的
+    # (binlog_file, offset, seq) 与数据在同一事务中更新，重试或 input 重启重放时跳过已应用的记录
+    config_param :position_table, :string, :default => nil
+
+    # 按表切分 chunk，多个 flush 线程并行写入不同的表
+    config_section :buffer do
+      config_set_default :chunk_keys, ['table']
+      config_set_default :flush_mode, :interval
+      config_set_default :flush_interval, 1
+      config_set_default :flush_thread_count, 4
+    end
 
     def configure(conf)
       super
       @binlog_files = {}
+      @offsets_mutex = Mutex.new
+      # 正在写入、等待写入或写入失败待重试的 chunk，见 wait_for_older_chunks
+      @ordered_chunks = {}
+      @ordered_chunks_mutex = Mutex.new
+      @ordered_chunks_cond = ConditionVariable.new
+      @pool_size ||= @buffer_config.flush_thread_count
+      @checkpoint = MysqlBinlogCheckpoint.new(@buffer_file_path)
     end
 
     def start
       super
-      @client = Mysql2::Client.new(host: @host, port: @port, username: @username, password: @password)
+      @checkpoint.load.each do |binlog_file, offset|
+        @binlog_files[binlog_file] = offset.to_i
+      end
+      @pool = Queue.new
+      @clients = []
+      @pool_size.times do
+        client = Mysql2::Client.new(host: @host, port: @port, username: @username, password: @password,
+                                    flags: Mysql2::Client::MULTI_STATEMENTS)
+        @clients << client
+        @pool.push(client)
+      end
+      create_position_table if @position_table
     end
 
     def shutdown
       super
-      @client.close if @client
+      @clients.each { |client| client.close } if @clients
+      @checkpoint.close
     end
 
-    def process(tag, es)
-      es.each do |time, record|
-
+    def write(chunk)
+      records = []
+      chunk.each do |time, record|
         # 若 output 执行先于 input，则会读到一些非法格式内容，这里做个过滤
-        if !record['sql'].nil?
-          sql = record['sql']
+        records << record if !record['sql'].nil?
+      end
+      return if records.empty?
+
+      begin
+        wait_for_older_chunks(chunk.unique_id, records)
+        with_client do |client|
+          if @position_table
+            apply_records_with_position(client, records)
+          else
+            apply_records(client, records)
+          end
+        end
+      rescue StandardError
+        chunk_failed(chunk.unique_id)
+        raise
+      end
+      chunk_written(chunk.unique_id)
+
+      # 事务提交后再更新 offset，只将有变化的 binlog_file 及其对应的 offset 追加到缓冲文件中
+      @offsets_mutex.synchronize do
+        records.each do |record|
           binlog_file = record['binlog_file']
-          offset = record['offset']
+          # 多个表并行写入，offset 只前进不后退
+          if @binlog_files[binlog_file].nil? || record['offset'] > @binlog_files[binlog_file]
+            @binlog_files[binlog_file] = record['offset']
+            @checkpoint.update(binlog_file, record['offset'])
+          end
+        end
+      end
+      @checkpoint.flush
+    end
+
+
+    private
+
+    def with_client
+      client = @pool.pop
+      begin
+        yield client
+      ensure
+        @pool.push(client)
+      end
+    end
+
+    # 同一 source、同一张表的 chunk 按其第一条记录在源库中的位置 (binlog_file, offset, seq) 排序：较早的 chunk 正在写入、
+    # 等待写入或写入失败待重试时，较新的 chunk 等待其完成，避免并行 flush 打乱顺序。位置由 input 按源库顺序生成，不会重复。
+    # DDL 及 sql 格式的记录没有 table，所在 chunk 作为屏障，与所有表的 chunk 互相排序
+    def wait_for_older_chunks(chunk_id, records)
+      tables = records.map { |record| record['table'].to_s }.uniq
+      deadline = Fluent::Clock.now + @ordering_timeout
+      @ordered_chunks_mutex.synchronize do
+        entry = (@ordered_chunks[chunk_id] ||= {})
+        entry[:source] = records.first['source'].to_s
+        entry[:position] = record_position(records.first)
+        entry[:table] = tables.length == 1 ? tables.first : ''
+        entry[:writing] = true
+        while older_chunk_pending?(chunk_id, entry)
+          remaining = deadline - Fluent::Clock.now
+          if remaining <= 0
+            raise "Older chunk of #{entry[:source]} #{entry[:table]} is still pending, retry later"
+          end
+          @ordered_chunks_cond.wait(@ordered_chunks_mutex, remaining)
+        end
+      end
+    end
+
+    def older_chunk_pending?(chunk_id, entry)
+      expire_failed_chunks
+      @ordered_chunks.any? do |other_id, other|
+        other_id != chunk_id && other[:source] == entry[:source] && (other[:position] <=> entry[:position]) < 0 &&
+          (other[:table] == entry[:table] || other[:table].empty? || entry[:table].empty?)
+      end
+    end
 
-          execute_sql(sql)
+    # 写入失败的 chunk 等待 Fluentd 重试，重试超时被丢弃后不再阻塞较新的 chunk
+    def expire_failed_chunks
+      return if @buffer_config.retry_forever
+      now = Fluent::Clock.now
+      @ordered_chunks.delete_if do |_, entry|
+        !entry[:writing] && now - entry[:failed_at] > @buffer_config.retry_timeout
+      end
+    end
 
-          # 将 offset 添加到对应 binlog_file 的数组中
-          @binlog_files[binlog_file] = offset
+    def chunk_written(chunk_id)
+      @ordered_chunks_mutex.synchronize do
+        @ordered_chunks.delete(chunk_id)
+        @ordered_chunks_cond.broadcast
+      end
+    end
+
+    def chunk_failed(chunk_id)
+      @ordered_chunks_mutex.synchronize do
+        entry = @ordered_chunks[chunk_id]
+        if entry
+          entry[:writing] = false
+          entry[:failed_at] ||= Fluent::Clock.now
         end
+        @ordered_chunks_cond.broadcast
       end
+    end
 
-      # 将每个 binlog_file 及其对应的 offset 记录到缓冲文件中
-      write_binlog_offsets_to_buffer_file
+    DML_TYPES = %w[INSERT UPDATE DELETE].freeze
+    DML_SQL_PATTERN = /\A\s*(INSERT|REPLACE|UPDATE|DELETE)\b/i
 
+    # DDL 会隐式提交当前事务，不能与其他语句放在同一事务中：json 格式按 type 判断，sql 格式按语句开头判断
+    def ddl_record?(record)
+      return !DML_TYPES.include?(record['type']) if record.key?('type')
+      return record['sql'] !~ DML_SQL_PATTERN
     end
 
+    # 按 DDL 切分记录，DDL 单独成组，其前后的 DML 各自成组
+    def split_by_ddl(records)
+      records.slice_when { |a, b| ddl_record?(a) || ddl_record?(b) }
+    end
 
-    private
+    # 先提交 DDL 之前的 DML，再单独执行 DDL，之后的 DML 开始新的事务。出错时抛出异常，由 Fluentd 重试整个 chunk，
+    # 未配置 position_table 时重试会再次执行出错前已提交的组
+    def apply_records(client, records)
+      split_by_ddl(records).each do |group|
+        if ddl_record?(group.first)
+          execute_multi_statements(client, group.first['sql'])
+        else
+          apply_dml_records(client, group)
+        end
+      end
+    end
 
-    def execute_sql(sql)
+    # 在一个事务中执行全部记录，一次提交；失败则回滚后抛出异常
+    def apply_dml_records(client, records)
       begin
-        @client.query(sql)
-      rescue StandardError => e
-        log.error "Error executing SQL query: #{e.message}"
+        client.query('BEGIN')
+        records.each_slice(@batch_statements) do |slice|
+          execute_multi_statements(client, slice.map { |record| record['sql'].strip.chomp(';') }.join(";\n"))
+        end
+        client.query('COMMIT')
+      rescue StandardError
+        rollback(client)
+        raise
+      end
+    end
+
+    def apply_records_with_position(client, records)
+      split_by_ddl(records).each do |group|
+        if ddl_record?(group.first)
+          apply_ddl_with_position(client, group.first)
+        else
+          apply_dml_records_with_position(client, group)
+        end
       end
     end
 
-    def write_binlog_offsets_to_buffer_file
-      File.open(@buffer_file_path, 'w') do |file|
-        @binlog_files.each do |binlog_file, offset|
-          file.puts "#{binlog_file}=#{offset}"
+    # DDL 无法与位置更新在同一事务中，执行成功后再在新事务中记录其位置
+    def apply_ddl_with_position(client, record)
+      return if skip_applied_records(client, [record]).empty?
+      execute_multi_statements(client, record['sql'])
+      client.query('BEGIN')
+      save_applied_positions(client, [record])
+      client.query('COMMIT')
+    end
+
+    # 与 apply_dml_records 相同，但在同一事务中跳过已应用的记录并更新已应用位置。失败时改为逐条执行，每条记录一个事务：
+    # 某个 source、表的记录出错后，该表之后的记录不再执行，其已应用位置停在出错记录之前；其他表继续执行，最后抛出异常，
+    # 由 Fluentd 重试 chunk 时跳过已应用的记录，从出错的记录重新开始
+    def apply_dml_records_with_position(client, records)
+      begin
+        client.query('BEGIN')
+        pending = skip_applied_records(client, records)
+        pending.each_slice(@batch_statements) do |slice|
+          execute_multi_statements(client, slice.map { |record| record['sql'].strip.chomp(';') }.join(";\n"))
+        end
+        save_applied_positions(client, pending)
+        client.query('COMMIT')
+      rescue StandardError => e
+        log.warn "Error applying #{records.length} SQL in one transaction, retry one by one: #{e.message}"
+        rollback(client)
+        failed_keys = {}
+        records.each do |record|
+          next if failed_keys[position_key(record)]
+          begin
+            client.query('BEGIN')
+            if !skip_applied_records(client, [record]).empty?
+              execute_multi_statements(client, record['sql'])
+              save_applied_positions(client, [record])
+            end
+            client.query('COMMIT')
+          rescue StandardError => e
+            log.error "Error executing SQL query: #{e.message}"
+            rollback(client)
+            failed_keys[position_key(record)] = true
+          end
         end
+        if !failed_keys.empty?
+          raise "Error applying SQL of #{failed_keys.keys.map { |key| key.join(' ') }.join(', ')}, retry later"
+        end
+      end
+    end
+
+    def position_key(record)
+      [record['source'].to_s, record['table'].to_s]
+    end
+
+    def record_position(record)
+      [record['binlog_file'].to_s, record['offset'].to_i, record['seq'].to_i]
+    end
+
+    # 锁定并读取每个 source、表的已应用位置，返回位置更靠后的记录
+    def skip_applied_records(client, records)
+      applied = {}
+      records.map { |record| position_key(record) }.uniq.each do |source, table|
+        row = client.query("SELECT binlog_file, binlog_offset, seq FROM #{@position_table_name} " \
+                           "WHERE source = '#{client.escape(source)}' AND table_name = '#{client.escape(table)}' " \
+                           "FOR UPDATE").first
+        applied[[source, table]] = [row['binlog_file'], row['binlog_offset'], row['seq']] if row
+      end
+
+      pending = records.select do |record|
+        position = applied[position_key(record)]
+        position.nil? || (record_position(record) <=> position) > 0
+      end
+      if pending.length < records.length
+        log.info "Skip #{records.length - pending.length} already applied SQL"
+      end
+      return pending
+    end
+
+    def save_applied_positions(client, records)
+      last_records = {}
+      records.each { |record| last_records[position_key(record)] = record }
+      last_records.each do |(source, table), record|
+        binlog_file, offset, seq = record_position(record)
+        client.query("INSERT INTO #{@position_table_name} (source, table_name, binlog_file, binlog_offset, seq) " \
+                     "VALUES ('#{client.escape(source)}', '#{client.escape(table)}', " \
+                     "'#{client.escape(binlog_file)}', #{offset}, #{seq}) " \
+                     "ON DUPLICATE KEY UPDATE binlog_file = VALUES(binlog_file), " \
+                     "binlog_offset = VALUES(binlog_offset), seq = VALUES(seq)")
       end
     end
 
+    def create_position_table
+      @position_table_name = @position_table.split('.').map { |name| "`#{name}`" }.join('.')
+      with_client do |client|
+        client.query("CREATE TABLE IF NOT EXISTS #{@position_table_name} (" \
+                     "source varchar(255) NOT NULL, " \
+                     "table_name varchar(255) NOT NULL, " \
+                     "binlog_file varchar(255) NOT NULL, " \
+                     "binlog_offset bigint NOT NULL, " \
+                     "seq int NOT NULL, " \
+                     "updated_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP, " \
+                     "PRIMARY KEY (source, table_name))")
+      end
+    end
+
+    def execute_multi_statements(client, sql)
+      client.query(sql)
+      # 多语句请求需要读完所有结果，后续语句的错误也在这里抛出
+      while client.next_result
+        client.store_result
+      end
+    end
+
+    def rollback(client)
+      client.query('ROLLBACK')
+    rescue StandardError => e
+      log.error "Error rolling back: #{e.message}"
+    end
+
   end
 end